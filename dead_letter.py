@@ -0,0 +1,128 @@
+"""
+Dead-letter queue of the issues that failed to upload.
+
+A failed upload is recorded with the class and message of the error and
+the number of attempts so far, in a file like the migration journal, so
+the failures outlive the run and --retry_failed can work on just them.
+Instead of holding up the migration, a failed issue is retried by a
+background thread, later and later, while the other issues keep going.
+"""
+import heapq
+import itertools
+import threading
+import time
+
+import migration_journal
+
+
+class DeadLetterQueue(migration_journal.MigrationJournal):
+    """
+    Append-only record of the failed uploads, keyed by tigris id, with a
+    thread retrying them with exponential backoff.
+    """
+
+    def __init__(self, path, max_attempts=5, delay=60, reset_attempts=False):
+        """
+        :param path: Path of the queue file, created on the first failure
+        :param max_attempts: Number of attempts after which an issue is left in the queue
+        :param delay: Seconds before the first retry, doubling with each one
+        :param reset_attempts: Count the attempts of the issues failed in earlier
+                               runs from zero again, for --retry_failed
+        """
+        super(DeadLetterQueue, self).__init__(path)
+        # Failed issues whose earlier attempts don't count
+        self.reset = self.pending() if reset_attempts else set()
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.scheduled = []
+        self.sequence = itertools.count()
+        self.retried = 0
+        self.drained = 0
+        self.thread = None
+
+    def failed(self, tigris_id, error, **fields):
+        """
+        Record a failed upload.
+
+        :param tigris_id: The tigris issue id
+        :param error: The exception raised
+        :param fields: Anything else worth keeping, e.g. gh_id
+        :return: The number of failed attempts of the issue so far
+        """
+        entry = self.get(tigris_id)
+        with self.condition:
+            reset = tigris_id in self.reset
+            self.reset.discard(tigris_id)
+        attempts = entry.get('attempts', 0) + 1 if entry.get('status') == 'failed' and not reset else 1
+        self.record(tigris_id, status='failed', error=type(error).__name__, message=str(error),
+                    attempts=attempts, **fields)
+        return attempts
+
+    def resolved(self, tigris_id):
+        """Record that an issue in the queue was uploaded after all."""
+        if self.get(tigris_id).get('status') == 'failed':
+            self.record(tigris_id, status='resolved')
+
+    def pending(self):
+        """Return the set of tigris ids of the issues still failed."""
+        with self.lock:
+            return set(tigris_id for tigris_id, entry in self.entries.items() if entry.get('status') == 'failed')
+
+    def retry_later(self, tigris_id, retry):
+        """
+        Have the background thread retry an issue after a backoff, unless
+        it had all its attempts.
+
+        :param tigris_id: The tigris issue id
+        :param retry: Function making the next attempt. It records its own failure.
+        """
+        attempts = self.get(tigris_id).get('attempts', 1)
+        if attempts >= self.max_attempts:
+            print("Giving up on tigris issue %d after %d attempts, see %s" % (tigris_id, attempts, self.path))
+            return
+        delay = min(self.delay * 2 ** (attempts - 1), 3600)
+        print("Retrying tigris issue %d in %gs" % (tigris_id, delay))
+        with self.condition:
+            heapq.heappush(self.scheduled, (time.time() + delay, next(self.sequence), tigris_id, retry))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run_retries, name='dead-letter-retries')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run_retries(self):
+        """Body of the background thread, making the retries when they're due."""
+        while True:
+            with self.condition:
+                while True:
+                    if not self.scheduled:
+                        self.thread = None
+                        self.condition.notify_all()
+                        return
+                    due = self.scheduled[0][0] - time.time()
+                    if due <= 0:
+                        break
+                    self.condition.wait(due)
+                _, _, tigris_id, retry = heapq.heappop(self.scheduled)
+            try:
+                if retry():
+                    self.retried += 1
+            except BaseException as e:
+                # Even a SystemExit, e.g. for a pull request at the number,
+                # mustn't end the thread with the retries scheduled, or
+                # drain() waits forever.
+                print("Retry of tigris issue %d failed: %r" % (tigris_id, e))
+
+    def drain(self):
+        """
+        Wait until the retries scheduled, and those they schedule, are done.
+
+        :return: Number of issues uploaded by a retry since the last drain()
+        """
+        with self.condition:
+            while self.thread is not None:
+                self.condition.wait()
+            retried = self.retried - self.drained
+            self.drained = self.retried
+        return retried
@@ -0,0 +1,138 @@
+"""
+Batched lookup of the current state of GitHub issues.
+
+Instead of one REST read per issue, the existence, pull request-ness and
+body of many issue numbers are resolved with a single aliased GraphQL
+query, and cached for the rest of the run.
+"""
+import hashlib
+import json
+import threading
+
+import github.Issue
+
+import http_transport
+
+DEFAULT_API_URL = 'https://api.github.com'
+
+
+def body_hash(body):
+    """Hash of an issue body, ignoring the line ending style GitHub stores."""
+    text = (body or '').replace('\r\n', '\n')
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class IssueStateCache(object):
+    """
+    State of the issues of one repository, by issue number. Each state is a
+    dict with 'exists', 'is_pull_request', 'title', 'state', 'body' and
+    'body_hash'. Safe to share between threads, like the fill workers and
+    the retries of the dead-letter queue.
+    """
+
+    def __init__(self, repo_name, token, api_url=DEFAULT_API_URL, batch_size=100):
+        """
+        :param repo_name: Repository like SCons/scons
+        :param token: GitHub personal access token, GraphQL takes no passwords
+        :param api_url: Base URL of the GitHub API, or of a local stand-in
+        :param batch_size: Issue numbers resolved per GraphQL request
+        """
+        self.owner, self.name = repo_name.split('/', 1)
+        self.token = token
+        self.graphql_url = api_url.rstrip('/') + '/graphql'
+        self.batch_size = batch_size
+        self.states = {}
+        # Reentrant, query() remembers. Held only around the cache, never
+        # around a request, so the workers don't queue behind each other's
+        # lookups.
+        self.lock = threading.RLock()
+
+    def build_query(self, numbers):
+        """Return an aliased GraphQL query for the given issue numbers."""
+        fields = []
+        for number in numbers:
+            fields.append(
+                'i%d: issueOrPullRequest(number: %d) { __typename '
+                '... on Issue { number title state body } '
+                '... on PullRequest { number } }' % (number, number))
+        return 'query { repository(owner: %s, name: %s) { %s } }' % (
+            json.dumps(self.owner), json.dumps(self.name), ' '.join(fields))
+
+    def query(self, numbers):
+        """Resolve the given issue numbers with one GraphQL request."""
+        r = http_transport.transport.post(self.graphql_url, json={'query': self.build_query(numbers)},
+                                          headers={'Authorization': 'bearer ' + self.token}, timeout=(10, 60))
+        if r.status_code == 401:
+            raise RuntimeError('GitHub refused the GraphQL lookup of %s/%s, --password has to be a '
+                               'personal access token, not the account password' % (self.owner, self.name))
+        r.raise_for_status()
+        result = r.json()
+        # Numbers without an issue or pull request come back as null,
+        # with a NOT_FOUND error each.
+        errors = [e for e in result.get('errors') or [] if e.get('type') != 'NOT_FOUND']
+        if errors:
+            raise RuntimeError('GraphQL query failed: %s' % errors[0].get('message'))
+        repository = (result.get('data') or {}).get('repository') or {}
+        with self.lock:
+            for number in numbers:
+                if number in self.states:
+                    # Remembered by a write while the query ran, that's newer
+                    continue
+                node = repository.get('i%d' % number)
+                if node is None:
+                    self.states[number] = {'exists': False, 'is_pull_request': False,
+                                           'title': None, 'state': None, 'body': None, 'body_hash': None}
+                elif node.get('__typename') == 'PullRequest':
+                    self.states[number] = {'exists': True, 'is_pull_request': True,
+                                           'title': None, 'state': None, 'body': None, 'body_hash': None}
+                else:
+                    self.remember(number, node.get('title'), node.get('state', '').lower(), node.get('body'))
+
+    def prefetch(self, numbers):
+        """Resolve all the given issue numbers not cached yet, in batches."""
+        with self.lock:
+            missing = sorted(set(n for n in numbers if n not in self.states))
+        for start in range(0, len(missing), self.batch_size):
+            self.query(missing[start:start + self.batch_size])
+
+    def get(self, number):
+        """
+        Return the state of an issue number. If it isn't cached yet, it's
+        resolved along with the numbers following it, which are likely
+        asked for next.
+        """
+        with self.lock:
+            state = self.states.get(number)
+        if state is None:
+            # Outside the lock, query() leaves alone what's remembered meanwhile
+            self.prefetch(range(number, number + self.batch_size))
+            with self.lock:
+                state = self.states[number]
+        return state
+
+    def remember(self, number, title, state, body):
+        """Record the state of an issue, e.g. after editing it."""
+        with self.lock:
+            self.states[number] = {'exists': True, 'is_pull_request': False,
+                                   'title': title, 'state': state,
+                                   'body': body, 'body_hash': body_hash(body)}
+
+    def remember_issue(self, gh_issue):
+        """Record the state of a PyGithub issue that was just edited."""
+        self.remember(gh_issue.number, gh_issue.title, gh_issue.state, gh_issue.body)
+
+    def lazy_issue(self, repo, number):
+        """
+        Return a PyGithub issue for a cached, existing issue number without
+        reading it from GitHub. Its body is the cached one, so appending
+        to it costs no request either.
+        """
+        with self.lock:
+            state = self.states[number]
+        attributes = {'number': number,
+                      'url': '%s/issues/%d' % (repo.url, number),
+                      'title': state['title'],
+                      'state': state['state'],
+                      'body': state['body']}
+        return github.Issue.Issue(repo._requester, {}, attributes, completed=False)
+
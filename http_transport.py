@@ -0,0 +1,155 @@
+"""
+HTTP transport shared by the Tigris download and the GitHub migration.
+
+All plain HTTP requests go through one requests.Session, so connections
+to a host are kept alive and reused instead of paying for a new TCP/TLS
+handshake each time. Every request gets connect and read timeouts, so a
+stalled server can't hang a run, and failed requests are retried under a
+replaceable retry policy. Per host, the transport counts requests,
+errors, retries and the time spent waiting for responses.
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+# Seconds to wait for a connection, and for the next bytes of a response
+DEFAULT_TIMEOUT = (10, 120)
+
+# Methods that may be repeated without changing the outcome
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+# Statuses worth retrying, the server is overloaded or restarting
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def default_retry_policy(method, attempt, response, error):
+    """
+    Decide whether to retry a failed request.
+
+    :param method: HTTP method of the request
+    :param attempt: Number of the failed attempt, starting at 1
+    :param response: The response, or None if the request raised
+    :param error: The requests.RequestException raised, or None
+    :return: Seconds to wait before the next attempt, or None to give up
+    """
+    if response is not None:
+        if response.status_code not in RETRY_STATUSES or method not in IDEMPOTENT_METHODS:
+            return None
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return int(retry_after)
+    elif method not in IDEMPOTENT_METHODS and not isinstance(error, requests.ConnectTimeout):
+        # Only a request that never reached the server is safe to repeat
+        return None
+    return min(2 ** attempt, 60)
+
+
+class Transport(object):
+    """
+    Pooled, instrumented HTTP client. Safe to share between threads.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_size=10, retries=3, retry_policy=default_retry_policy):
+        """
+        :param timeout: Default (connect, read) timeout in seconds
+        :param pool_size: Default number of kept alive connections per host
+        :param retries: Default number of retries of a failed request
+        :param retry_policy: Function like default_retry_policy()
+        """
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.retry_policy = retry_policy
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def set_pool_size(self, url, pool_size):
+        """
+        Keep up to pool_size connections alive to the host of url, e.g. one
+        per worker thread talking to it.
+        """
+        parts = urlsplit(url)
+        self.session.mount('%s://%s/' % (parts.scheme, parts.netloc),
+                           requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+
+    def count(self, host, field, value=1):
+        """Add value to a counter of a host."""
+        with self.lock:
+            stats = self.stats.setdefault(host, {'requests': 0, 'errors': 0, 'retries': 0, 'seconds': 0.0})
+            stats[field] += value
+
+    def request(self, method, url, retries=None, **kwargs):
+        """
+        Make a request, retrying failed ones as the retry policy says.
+
+        :param method: HTTP method like 'GET'
+        :param url: URL of the request
+        :param retries: Number of retries, instead of the default
+        :param kwargs: Passed on to requests, like params, data or stream
+        :return: The requests.Response of the last attempt
+        """
+        method = method.upper()
+        host = urlsplit(url).netloc
+        kwargs.setdefault('timeout', self.timeout)
+        if retries is None:
+            retries = self.retries
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.time()
+            response = error = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            self.count(host, 'requests')
+            self.count(host, 'seconds', time.time() - started)
+            if error is None and response.status_code < 400:
+                return response
+            self.count(host, 'errors')
+
+            delay = None
+            if attempt <= retries:
+                delay = self.retry_policy(method, attempt, response, error)
+            if delay is None:
+                if error is not None:
+                    raise error
+                return response
+            print("%s %s failed (%s), retrying in %ds" %
+                  (method, url, error or response.status_code, delay))
+            if response is not None:
+                response.close()
+            self.count(host, 'retries')
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def report(self):
+        """Return lines summing up the requests made, per host."""
+        lines = []
+        with self.lock:
+            for host in sorted(self.stats):
+                stats = self.stats[host]
+                lines.append("%s: %d request(s), %d error(s), %d retried, %.1fs waiting" %
+                             (host, stats['requests'], stats['errors'], stats['retries'], stats['seconds']))
+        return lines
+
+
+# The transport used by all modules
+transport = Transport()
@@ -0,0 +1,233 @@
+"""
+Index of the parsed Tigris issues, to select the issues a run works on.
+
+A selection is a list of filters like
+
+    status=NEW,STARTED        the field has one of the values
+    milestone!=-unspecified-  the field has none of the values
+    attachments=yes           the issue has attachments (or 'no')
+    changed>=2005-01-01       delta_ts in a date window, also <, <=, >
+    created<2004              creation_ts, compared the same way
+    id>=1000                  the Tigris issue id
+
+and an issue is selected when it passes all of them.
+
+The same filters order the work by priority, issues passing a filter
+coming first. Besides them, 'open' puts the issues that aren't resolved
+first, and 'recent' the most recently changed ones.
+"""
+import argparse
+import bisect
+import re
+
+import import_tigris
+
+# Short names for the fields of a Tigris issue
+FIELD_ALIASES = {
+    'status': 'issue_status',
+    'type': 'issue_type',
+    'milestone': 'target_milestone',
+    'assignee': 'assigned_to',
+    'keyword': 'keywords',
+    'platform': 'rep_platform',
+}
+
+# Fields looked up by value
+INDEXED_FIELDS = ('issue_status', 'resolution', 'priority', 'issue_type',
+                  'component', 'subcomponent', 'version', 'rep_platform',
+                  'op_sys', 'target_milestone', 'reporter', 'assigned_to',
+                  'keywords', 'attachments')
+
+# Fields compared by order, and the issue field they come from
+ORDERED_FIELDS = {
+    'created': 'creation_ts',
+    'changed': 'delta_ts',
+    'id': 'issue_id',
+}
+
+# Statuses of issues that are done with
+CLOSED_STATUSES = ('RESOLVED', 'CLOSED', 'VERIFIED')
+
+FILTER_RE = re.compile(r'^(\w+)\s*(!=|>=|<=|=|>|<)\s*(.*)$')
+
+
+def parse_filter(text):
+    """
+    Parse a single filter, usable as an argparse type.
+
+    :param text: Filter like 'status=NEW,STARTED'
+    :return: Tuple (field, operator, values)
+    """
+    m = FILTER_RE.match(text.strip())
+    if not m:
+        raise argparse.ArgumentTypeError("Can't parse filter '%s'" % text)
+    field, op, value = m.groups()
+    field = FIELD_ALIASES.get(field, field)
+    if field in ORDERED_FIELDS:
+        if op in ('=', '!='):
+            raise argparse.ArgumentTypeError("Use <, <=, > or >= with '%s'" % field)
+        if field == 'id':
+            value = int(value)
+        return field, op, value
+    if field not in INDEXED_FIELDS:
+        raise argparse.ArgumentTypeError("Unknown field '%s' in filter '%s'" % (field, text))
+    if op not in ('=', '!='):
+        raise argparse.ArgumentTypeError("Use = or != with '%s'" % field)
+    return field, op, [v.strip() for v in value.split(',')]
+
+
+def issue_field_values(tigris_issue, field):
+    """Return the values an issue has for an indexed field."""
+    if field == 'keywords':
+        return import_tigris.issue_keywords(tigris_issue)
+    if field == 'attachments':
+        return ['yes' if tigris_issue.get('attachment') else 'no']
+    return [tigris_issue.get(field, '')]
+
+
+def build_issue_index(tigris_issues):
+    """
+    Build the index for select_issues().
+
+    :param tigris_issues: Dictionary of tigris id to issue record
+    :return: Dictionary with all ids, a {value: set of ids} map per
+    indexed field, and per ordered field a tuple of the sorted values
+    and the ids in the same order
+    """
+    index = {'all': set(tigris_issues)}
+    for field in INDEXED_FIELDS:
+        index[field] = {}
+    for field in ORDERED_FIELDS:
+        index[field] = []
+
+    for tigris_id, tigris_issue in tigris_issues.items():
+        for field in INDEXED_FIELDS:
+            for value in issue_field_values(tigris_issue, field):
+                index[field].setdefault(value, set()).add(tigris_id)
+        for field, source in ORDERED_FIELDS.items():
+            value = tigris_id if field == 'id' else tigris_issue.get(source, '')
+            index[field].append((value, tigris_id))
+
+    for field in ORDERED_FIELDS:
+        entries = sorted(index[field])
+        index[field] = ([k for k, _ in entries], [i for _, i in entries])
+    return index
+
+
+def ordered_range(keys, op, value):
+    """
+    Return the slice (start, end) of sorted keys passing a filter on an
+    ordered field. Used on a single key too, so the index and the issues
+    streamed without one compare alike.
+    """
+    # Dates match on their prefix, so 'changed<=2004-05' includes all of May
+    upper = value + '\uffff' if isinstance(value, str) else value
+    if op == '<':
+        return 0, bisect.bisect_left(keys, value)
+    elif op == '<=':
+        return 0, bisect.bisect_right(keys, upper)
+    elif op == '>':
+        return bisect.bisect_right(keys, upper), len(keys)
+    return bisect.bisect_left(keys, value), len(keys)
+
+
+def match_filter(index, field, op, value):
+    """Return the set of ids passing a single parsed filter."""
+    if field in ORDERED_FIELDS:
+        keys, ids = index[field]
+        start, end = ordered_range(keys, op, value)
+        return set(ids[start:end])
+
+    matches = set()
+    for v in value:
+        matches |= index[field].get(v, set())
+    if op == '!=':
+        return index['all'] - matches
+    return matches
+
+
+def select_issues(index, filters):
+    """
+    Select the issues passing all filters.
+
+    :param index: Index from build_issue_index()
+    :param filters: List of filters from parse_filter()
+    :return: Set of the selected tigris ids
+    """
+    selected = set(index['all'])
+    for field, op, value in filters:
+        selected &= match_filter(index, field, op, value)
+    return selected
+
+
+def issue_matches(tigris_id, tigris_issue, filters):
+    """
+    Whether a single issue passes all filters, for issues streamed one by
+    one without an index.
+
+    :param tigris_id: The tigris issue id
+    :param tigris_issue: The issue record
+    :param filters: List of filters from parse_filter()
+    """
+    for field, op, value in filters:
+        if field in ORDERED_FIELDS:
+            key = tigris_id if field == 'id' else tigris_issue.get(ORDERED_FIELDS[field], '')
+            start, end = ordered_range([key], op, value)
+            passed = start < end
+        else:
+            passed = any(v in value for v in issue_field_values(tigris_issue, field))
+            if op == '!=':
+                passed = not passed
+        if not passed:
+            return False
+    return True
+
+
+def parse_priority(text):
+    """
+    Parse a single priority, usable as an argparse type.
+
+    :param text: 'open', 'recent' or a filter like 'milestone=2.0'
+    :return: The keyword, or a filter from parse_filter()
+    """
+    if text.strip() in ('open', 'recent'):
+        return text.strip()
+    return parse_filter(text)
+
+
+def priority_key(tigris_id, tigris_issue, priority):
+    """Sort key of an issue for a single priority, lower comes first."""
+    if priority == 'open':
+        return tigris_issue.get('issue_status') in CLOSED_STATUSES
+    elif priority == 'recent':
+        return tigris_issue.get('delta_ts', '')
+    return not issue_matches(tigris_id, tigris_issue, [priority])
+
+
+def order_by_priority(tigris_issues, tigris_ids, priorities):
+    """
+    Order issues by priority. Issues the priorities don't tell apart keep
+    their order in tigris_ids.
+
+    :param tigris_issues: Dictionary of tigris id to issue record
+    :param tigris_ids: The tigris ids to order
+    :param priorities: List of priorities from parse_priority(), the first
+    one weighing most
+    :return: List of the tigris ids, highest priority first
+
+    A filter puts first exactly the issues select_issues() selects:
+
+    >>> issues = dict((i, {'issue_id': str(i)}) for i in range(1, 6))
+    >>> sorted(select_issues(build_issue_index(issues), [parse_filter('id<=2')]))
+    [1, 2]
+    >>> order_by_priority(issues, [5, 4, 3, 2, 1], [parse_priority('id<=2')])
+    [2, 1, 5, 4, 3]
+    >>> order_by_priority(issues, [1, 2, 3, 4, 5], [parse_priority('id>3')])
+    [4, 5, 1, 2, 3]
+    """
+    ordered = list(tigris_ids)
+    # Stable sorts, least important priority first
+    for priority in reversed(priorities):
+        ordered.sort(key=lambda tigris_id: priority_key(tigris_id, tigris_issues[tigris_id], priority),
+                     reverse=priority == 'recent')
+    return ordered
@@ -0,0 +1,173 @@
+"""
+Leases coordinating several migration workers, in one SQLite file.
+
+The work of a migration is cut into named pieces, like the reservation
+of the issue numbers, or filling in the issues of a range of tigris ids.
+A worker claims a piece by taking its lease, keeps the lease alive with
+heartbeats while working on it, and marks it done at the end. A lease
+not renewed in time has expired, so a worker that crashed or hangs loses
+its piece to the next worker claiming one.
+
+The workers may run on one host, or on several sharing the file, as
+long as the file system locks SQLite files properly.
+"""
+import contextlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS leases (
+    scope TEXT NOT NULL,
+    name TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    owner TEXT,
+    expires REAL NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (scope, name, first)
+)
+'''
+
+
+def default_worker_id():
+    """Name of this worker, unique among the processes of all hosts."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class LeaseStore(object):
+    """
+    The leases of one worker. Safe to share between threads, each
+    operation opens its own connection.
+    """
+
+    def __init__(self, path, worker_id=None, lease_seconds=120):
+        """
+        :param path: Path of the SQLite file, created if need be
+        :param worker_id: Name of this worker, by default from the host name and process id
+        :param lease_seconds: Seconds a lease lasts without a heartbeat
+        """
+        self.path = path
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+        with self.transaction() as db:
+            db.execute(SCHEMA)
+
+    def connect(self):
+        """Open a connection, waiting for other workers' transactions."""
+        return sqlite3.connect(self.path, timeout=60)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Connection committing at the end of the with block, or rolling back on an error."""
+        db = self.connect()
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, scope, name, first=0, last=0):
+        """
+        Add a piece of work, unless some worker added it already.
+
+        :param scope: What the piece belongs to, e.g. the GitHub repo
+        :param name: Kind of work, e.g. 'reserve' or 'fill'
+        :param first: First tigris id of the piece, if it's a range
+        :param last: Last tigris id of the piece, if it's a range
+        """
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO leases (scope, name, first, last) VALUES (?, ?, ?, ?)',
+                       (scope, name, first, last))
+
+    def add_many(self, scope, name, ranges):
+        """
+        Add several pieces of a kind of work at once, in one transaction,
+        leaving out those some worker added already.
+
+        :param scope: What the pieces belong to, e.g. the GitHub repo
+        :param name: Kind of work, e.g. 'fill'
+        :param ranges: Iterable of (first, last) tigris ids of the pieces
+        """
+        with self.transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO leases (scope, name, first, last) VALUES (?, ?, ?, ?)',
+                           [(scope, name, first, last) for first, last in ranges])
+
+    def claim(self, scope, name):
+        """
+        Take the lease of the first piece of a kind of work nobody holds, or
+        whose holder let it expire.
+
+        :return: (first, last) of the piece claimed, or None if there's none to claim
+        """
+        db = self.connect()
+        try:
+            # Lock the file for writing right away, so no other worker
+            # claims the same piece in between.
+            db.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = db.execute('SELECT first, last, owner FROM leases '
+                             'WHERE scope = ? AND name = ? AND done = 0 AND (owner IS NULL OR expires < ?) '
+                             'ORDER BY first LIMIT 1', (scope, name, now)).fetchone()
+            if row is None:
+                db.rollback()
+                return None
+            first, last, owner = row
+            db.execute('UPDATE leases SET owner = ?, expires = ? WHERE scope = ? AND name = ? AND first = ?',
+                       (self.worker_id, now + self.lease_seconds, scope, name, first))
+            db.commit()
+        finally:
+            db.close()
+        if owner is not None:
+            print("Worker %s took over %s %d-%d from %s" % (self.worker_id, name, first, last, owner))
+        return first, last
+
+    def finish(self, scope, name, first):
+        """
+        Mark a piece claimed by this worker done.
+
+        :return: False if the lease had expired and another worker took it over
+        """
+        with self.transaction() as db:
+            cursor = db.execute('UPDATE leases SET done = 1 WHERE scope = ? AND name = ? AND first = ? AND owner = ?',
+                                (scope, name, first, self.worker_id))
+        if cursor.rowcount == 0:
+            print("Worker %s lost its lease of %s %d to another worker" % (self.worker_id, name, first))
+            return False
+        return True
+
+    def pending(self, scope, name):
+        """Return the number of pieces of a kind of work not done yet."""
+        with self.transaction() as db:
+            return db.execute('SELECT COUNT(*) FROM leases WHERE scope = ? AND name = ? AND done = 0',
+                              (scope, name)).fetchone()[0]
+
+    def heartbeat(self):
+        """Renew all the leases this worker holds."""
+        with self.transaction() as db:
+            db.execute('UPDATE leases SET expires = ? WHERE owner = ? AND done = 0',
+                       (time.time() + self.lease_seconds, self.worker_id))
+
+    def start_heartbeat(self):
+        """Renew the leases from a background thread, three times a lease."""
+        def run():
+            while not self.stopped.wait(self.lease_seconds / 3.0):
+                try:
+                    self.heartbeat()
+                except sqlite3.Error as e:
+                    print("Heartbeat of worker %s failed: %s" % (self.worker_id, e))
+        self.stopped.clear()
+        self.heartbeat_thread = threading.Thread(target=run, name='lease-heartbeat')
+        self.heartbeat_thread.daemon = True
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        """Stop the thread of start_heartbeat()."""
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
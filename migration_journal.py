@@ -0,0 +1,87 @@
+"""
+Journal of what a migration has applied to GitHub.
+
+The journal is a file with one JSON object per line, which is only ever
+appended to, so several threads or processes can report into the same
+file and a crash loses at most the line being written. Reading it back
+merges all the lines for an issue, later ones winning.
+"""
+import json
+import os
+import threading
+import time
+
+
+class MigrationJournal(object):
+    """
+    Append-only record of the issues applied to GitHub, keyed by tigris id.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the journal file, created on the first record
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.reload()
+
+    def reload(self):
+        """Read the journal file again, e.g. to see what other processes wrote."""
+        entries = {}
+        cut_short = False
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f_in:
+                for line in f_in:
+                    cut_short = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Line cut short by a crash
+                        continue
+                    entries.setdefault(entry['tigris_id'], {}).update(entry)
+        with self.lock:
+            self.entries = entries
+            # Don't append to the end of a line cut short by a crash
+            self.needs_newline = cut_short
+
+    def record(self, tigris_id, **fields):
+        """
+        Append an entry for an issue.
+
+        :param tigris_id: The tigris issue id
+        :param fields: Anything worth keeping, e.g. gh_id, delta_ts, status
+        """
+        entry = dict(fields, tigris_id=tigris_id, time=time.strftime('%Y-%m-%d %H:%M:%S'))
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self.lock:
+            if self.needs_newline:
+                line = '\n' + line
+                self.needs_newline = False
+            with open(self.path, 'a') as f_out:
+                f_out.write(line)
+            self.entries.setdefault(tigris_id, {}).update(entry)
+
+    def get(self, tigris_id):
+        """Return the merged entry for an issue, or an empty dict."""
+        with self.lock:
+            return dict(self.entries.get(tigris_id, {}))
+
+    def applied_delta(self, tigris_id):
+        """Return the delta_ts last uploaded for an issue, or None."""
+        return self.get(tigris_id).get('delta_ts')
+
+    def changed_issues(self, tigris_issues):
+        """
+        Find the issues that are new, or changed on Tigris since uploaded.
+
+        :param tigris_issues: Dictionary of tigris id to issue record
+        :return: Set of tigris ids
+        """
+        return set(tigris_id for tigris_id, tigris_issue in tigris_issues.items()
+                   if self.is_changed(tigris_id, tigris_issue))
+
+    def is_changed(self, tigris_id, tigris_issue):
+        """Whether an issue is new, or changed on Tigris since uploaded."""
+        applied = self.applied_delta(tigris_id)
+        return applied is None or tigris_issue.get('delta_ts', '') > applied
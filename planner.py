@@ -0,0 +1,175 @@
+"""
+Planning of a migration before running it.
+
+A MigrationPlan counts what a run would do: issues to create or update,
+milestones and labels that don't exist yet, attachments and their size,
+relationship edges, and the API calls per endpoint. From those it
+estimates the wall time, under the hourly rate budget of the token, the
+pacing of writes and the number of workers.
+"""
+import concurrent.futures
+
+import http_transport
+
+# Endpoints that create or change content on GitHub, paced as writes
+WRITE_ENDPOINTS = (
+    'POST issues',
+    'PATCH issue',
+    'POST milestones',
+    'PUT contents',
+    'POST asset',
+)
+
+# Fixed delays of the default upload, in seconds, see tigris2github.py
+DEFAULT_DELAY_PER_ISSUE = 5
+DEFAULT_DELAY_PER_CREATE = 6
+DEFAULT_DELAY_PER_RELATIONSHIP = 1
+DEFAULT_DELAY_PER_100 = 60
+
+
+class MigrationPlan(object):
+    """
+    What a migration run would do, counted without doing it.
+    """
+
+    def __init__(self, mode):
+        """
+        :param mode: 'default', 'two_phase' or 'pipeline'
+        """
+        self.mode = mode
+        self.issues = 0
+        self.creates = 0
+        self.updates = 0
+        self.placeholders = 0
+        self.new_milestones = set()
+        self.new_labels = set()
+        self.attachments = 0
+        self.attachment_bytes = 0
+        self.unknown_sizes = 0
+        self.relationship_edges = 0
+        self.relationship_issues = 0
+        self.calls = {}
+
+    def add_call(self, endpoint, count=1):
+        """Count count calls of an API endpoint."""
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + count
+
+    def github_calls(self):
+        """Number of calls to GitHub, all endpoints but Tigris' together."""
+        return sum(count for endpoint, count in self.calls.items() if not endpoint.startswith('Tigris'))
+
+    def write_calls(self):
+        """Number of calls to GitHub writing something."""
+        return sum(self.calls.get(endpoint, 0) for endpoint in WRITE_ENDPOINTS)
+
+    def estimate(self, rate_budget, write_interval, workers, latency):
+        """
+        Estimate the wall time of the run. It can't be shorter than any of
+        the limits it's under, so the longest of them is the estimate.
+
+        :param rate_budget: GitHub requests per hour of the token
+        :param write_interval: Seconds between writes of --two_phase and --pipeline
+        :param workers: Number of threads working in parallel
+        :param latency: Assumed seconds per request
+        :return: Dictionary of limit to seconds, 'total' being the estimate
+        """
+        all_calls = sum(self.calls.values())
+        bounds = {'rate budget': self.github_calls() * 3600.0 / rate_budget}
+        if self.mode == 'default':
+            # One issue after the other, with fixed delays in between
+            bounds['delays and requests'] = (
+                self.issues * DEFAULT_DELAY_PER_ISSUE +
+                self.creates * DEFAULT_DELAY_PER_CREATE +
+                self.issues * DEFAULT_DELAY_PER_RELATIONSHIP +
+                2 * (self.issues // 100) * DEFAULT_DELAY_PER_100 +
+                all_calls * latency)
+        else:
+            bounds['write pacing'] = self.write_calls() * write_interval
+            if self.mode == 'pipeline':
+                # Only the attachment downloads run in parallel
+                downloads = self.calls.get('Tigris attachment', 0)
+                bounds['requests'] = (all_calls - downloads) * latency + downloads * latency / workers
+            else:
+                bounds['requests'] = all_calls * latency / workers
+        bounds['total'] = max(bounds.values())
+        return bounds
+
+    def report(self, rate_budget, write_interval, workers, latency):
+        """Return the lines of a human readable report."""
+        lines = [
+            "Issues: %d, %d to create, %d to update" % (self.issues, self.creates, self.updates),
+        ]
+        if self.placeholders:
+            lines.append("Placeholders for numbers without an issue: %d" % self.placeholders)
+        lines.append("Milestones to create: %d%s" % (len(self.new_milestones), format_names(self.new_milestones)))
+        lines.append("Labels to create: %d%s" % (len(self.new_labels), format_names(self.new_labels)))
+        size = format_bytes(self.attachment_bytes)
+        if self.unknown_sizes:
+            size += ' and %d of unknown size' % self.unknown_sizes
+        lines.append("Attachments: %d, %s" % (self.attachments, size))
+        lines.append("Relationship edges: %d, on %d issues" % (self.relationship_edges, self.relationship_issues))
+        lines.append("API calls:")
+        for endpoint in sorted(self.calls):
+            lines.append("    %-20s %d" % (endpoint, self.calls[endpoint]))
+        lines.append("Estimated time with %d requests/hour, %d worker(s), %.2fs per request:" %
+                     (rate_budget, workers, latency))
+        bounds = self.estimate(rate_budget, write_interval, workers, latency)
+        for limit in sorted(bounds):
+            if limit != 'total':
+                lines.append("    %-20s %s" % (limit, format_seconds(bounds[limit])))
+        lines.append("    %-20s %s" % ('total', format_seconds(bounds['total'])))
+        return lines
+
+
+def format_names(names, limit=10):
+    """Format the first few of a set of names for a report line."""
+    if not names:
+        return ''
+    names = sorted(names)
+    text = ', '.join(names[:limit])
+    if len(names) > limit:
+        text += ', ...'
+    return ' (' + text + ')'
+
+
+def format_bytes(size):
+    """Format a number of bytes like 12.3 MB."""
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    if unit == 'bytes':
+        return '%d bytes' % size
+    return '%.1f %s' % (size, unit)
+
+
+def format_seconds(seconds):
+    """Format a duration like 3h 25m."""
+    minutes = int(seconds + 59) // 60
+    if minutes < 60:
+        return '%dm' % minutes
+    return '%dh %02dm' % (minutes // 60, minutes % 60)
+
+
+def attachment_size(url):
+    """Size of a Tigris attachment from a HEAD request, or None if it doesn't tell."""
+    try:
+        r = http_transport.transport.head(url, allow_redirects=True)
+    except Exception as e:
+        print("Can't get the size of %s: %s" % (url, e))
+        return None
+    length = r.headers.get('Content-Length')
+    if r.status_code >= 400 or not length or not length.isdigit():
+        return None
+    return int(length)
+
+
+def attachment_sizes(urls, workers=4):
+    """
+    Get the sizes of attachments with HEAD requests, workers at a time.
+
+    :param urls: The attachment_iz_url of the attachments
+    :return: List of the sizes, None where unknown
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(attachment_size, urls))
@@ -0,0 +1,45 @@
+"""
+Pacing of the write requests made to GitHub.
+
+GitHub asks integrators to leave about a second between requests that
+create or change content, on top of the hourly rate limit. A single
+RateGovernor is shared by everything writing to GitHub, including
+parallel workers, so together they never go faster than that.
+"""
+import threading
+import time
+
+
+class RateGovernor(object):
+    """
+    Hands out evenly spaced slots for write requests, and holds them all
+    back while the hourly rate limit is nearly used up.
+    """
+
+    def __init__(self, interval=1.0, gh=None, min_remaining=10):
+        """
+        :param interval: Seconds between two write requests
+        :param gh: Optional Github handle whose rate limit is watched
+        :param min_remaining: Wait for the reset below this many requests left
+        """
+        self.interval = interval
+        self.gh = gh
+        self.min_remaining = min_remaining
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+
+    def wait(self):
+        """Block until the caller may make its next write request."""
+        with self.lock:
+            now = time.time()
+            if self.gh is not None and self.gh.rate_limiting[0] < self.min_remaining:
+                reset_time = self.gh.rate_limiting_resettime
+                delay = 10 + (reset_time - now)
+                if delay > 0:
+                    print('Waiting ' + str(delay) + 's for rate limit to reset.')
+                    self.next_slot = max(self.next_slot, now + delay)
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        delay = slot - time.time()
+        if delay > 0:
+            time.sleep(delay)
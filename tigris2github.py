@@ -3,21 +3,32 @@
 import sys
 import argparse
 import base64
+import collections
+import concurrent.futures
 import getpass
-import glob
 import html
 import json
+import mimetypes
+import os
 import re
 import tempfile
+import threading
 import time
 import pprint
 
 from github import Github, UnknownObjectException
 import lxml
 import lxml.etree
-import requests
 
+import dead_letter
+import github_state
+import http_transport
 import import_tigris
+import issue_index
+import lease_store
+import migration_journal
+import planner
+import rate_limit
 
 my_printer = pp = pprint.PrettyPrinter(indent=4)
 
@@ -26,51 +37,53 @@ def escape_issue_markdown_repl(matchobj):
     return '#<span></span>' + matchobj.group(1)
 
 
-def get_target_milestone(tigris_issue, gh_issue):
+# GitHub milestones by (repo, title), shared by the fill workers so a
+# milestone is looked up and created only once.
+milestone_cache = {}
+milestone_lock = threading.Lock()
+
+
+def get_target_milestone(tigris_issue, repo):
     '''Get a GitHub milestone if the Tigris issue has one.'''
     milestone = None
-    tigris_milestone = tigris_issue.xpath('target_milestone')[0].text
-    if tigris_milestone != '-unspecified-':
-        for m in gh_issue.repository.get_milestones():
-            if m.title == tigris_milestone:
-                milestone = m
-                break
-        if not milestone:
-            milestone = gh_issue.repository.create_milestone(
-                tigris_milestone, description="Created automatically")
+    tigris_milestone = tigris_issue.get('target_milestone')
+    if tigris_milestone and tigris_milestone != '-unspecified-':
+        with milestone_lock:
+            key = (repo.full_name, tigris_milestone)
+            milestone = milestone_cache.get(key)
+            if not milestone:
+                for m in repo.get_milestones():
+                    if m.title == tigris_milestone:
+                        milestone = m
+                        break
+            if not milestone:
+                milestone = repo.create_milestone(
+                    tigris_milestone, description="Created automatically")
+            milestone_cache[key] = milestone
     return milestone
 
 
-def import_issue_file_loc(tigris_issue, gh_issue):
+def get_file_loc_text(tigris_issue):
     '''optional'''
-    issue_file_loc = tigris_issue.xpath('issue_file_loc')
-    if issue_file_loc and issue_file_loc[0].text:
-        gh_issue.edit(
-            body=gh_issue.body +
-            '\r\nMore information about this issue is at ' +
-            issue_file_loc[0].text +
-            '.\r\n')
+    issue_file_loc = tigris_issue.get('issue_file_loc')
+    if issue_file_loc:
+        return '\r\nMore information about this issue is at ' + issue_file_loc + '.\r\n'
+    return ''
 
 
-def import_votes(tigris_issue, gh_issue):
+def get_votes_text(tigris_issue):
     '''optional'''
-    votes = tigris_issue.xpath('votes')
-    if votes and votes[0].text:
-        gh_issue.edit(body=gh_issue.body +
-                      '\r\nVotes for this issue: ' + votes[0].text + '.\r\n')
+    votes = tigris_issue.get('votes')
+    if votes:
+        return '\r\nVotes for this issue: ' + votes + '.\r\n'
+    return ''
 
 
 def get_keyword_labels(tigris_issue):
     '''Create a label for each keyword.'''
     # There can be many keywords fields, each containing comma-separated
     # values.
-    labels = []
-    if len(tigris_issue.xpath('keywords')) > 0:
-        for keywords in tigris_issue.xpath('keywords'):
-            for keyword in keywords:
-                if keyword.text:
-                    labels.append(keyword.text.split(',').strip())
-    return labels
+    return import_tigris.issue_keywords(tigris_issue)
 
 
 def get_labels(tigris_issue):
@@ -82,11 +95,11 @@ def get_labels(tigris_issue):
         ('subcomponent', 'scons'),
         ('op_sys', 'All')
     ):
-        field_value = tigris_issue.xpath(field_name)[0].text
+        field_value = tigris_issue.get(field_name)
         if field_value and (field_value != default_value):
             labels.append(str(field_name.replace(
                 '_', ' ').title() + ': ' + field_value))
-    priority = tigris_issue.xpath('priority')[0].text
+    priority = tigris_issue.get('priority')
     if priority:
         labels.append(priority)
     # Map between Tigris issue_type and the default labels on GitHub.
@@ -94,7 +107,7 @@ def get_labels(tigris_issue):
         'DEFECT': 'bug',
         'ENHANCEMENT': 'enhancement'
     }
-    issue_type = type_map.get(tigris_issue.xpath('issue_type')[0].text)
+    issue_type = type_map.get(tigris_issue.get('issue_type'))
     if issue_type:
         labels.append(issue_type)
     # Map between Tigris resolutions and the default labels on GitHub.
@@ -104,7 +117,7 @@ def get_labels(tigris_issue):
         'WONTFIX': 'wontfix'
     }
     resolution_map = resolution_map.get(
-        tigris_issue.xpath('resolution')[0].text)
+        tigris_issue.get('resolution'))
     if resolution_map:
         labels.append(resolution_map)
     return labels
@@ -112,32 +125,30 @@ def get_labels(tigris_issue):
 
 def get_relationship_text(tigris_issue, gh_issue, tigris_to_github, field_name, relationship):
     suffix = ''
-    sorted_fields = sorted(tigris_issue.xpath(field_name), key=lambda x: x.xpath('when')[0].text)
+    sorted_fields = sorted(tigris_issue.get(field_name, []), key=lambda x: x.get('when', ''))
 
     for field in sorted_fields:
-        if not field.xpath('issue_id')[0].text:
+        if not field.get('issue_id'):
             # Some relationships are empty, so skip over them.
             continue
         
         # Get the tigris issue ID this bug has a relationship with
-        rel_issue_id = int(field.xpath('issue_id')[0].text)
+        rel_issue_id = int(field['issue_id'])
 
-        suffix += '\r\n' + field.xpath('who')[0].text
+        suffix += '\r\n' + field.get('who', '')
         suffix += ' said this issue ' + relationship + ' #'
 
         # Use the github issue id for the related tigris issue id
         suffix += str(tigris_to_github[rel_issue_id])
-        suffix += ' at ' + field.xpath('when')[0].text + '.\r\n'
+        suffix += ' at ' + field.get('when', '') + '.\r\n'
     return suffix
 
 
-def add_relationships(tigris_issue, gh_issue, tigris_to_github, tigris_id, gh_id):
-    '''Add the relationships between issues to GitHub.
-    :Param tigris_issue: XML Element with the current issue.
-    :Param gh_issue: handle to github issue
+def get_relationships_text(tigris_issue, gh_issue, tigris_to_github):
+    '''Text describing all the relationships of an issue, with GitHub numbers.
+    :Param tigris_issue: Record with the current issue.
+    :Param gh_issue: handle to github issue, or None
     :Param tigris_to_github: map from tigris issue number to github issue number
-    :Param tigris_id: the number of the current tigris issue
-    :Param gh_id: The number of the github issue
     '''
     suffix = ''
     for field_name, relationship in (
@@ -148,151 +159,335 @@ def add_relationships(tigris_issue, gh_issue, tigris_to_github, tigris_id, gh_id
     ):
         suffix += get_relationship_text(tigris_issue, gh_issue,
                                         tigris_to_github, field_name, relationship)
+    return suffix
+
+
+def add_relationships(tigris_issue, gh_issue, tigris_to_github, tigris_id, gh_id):
+    '''Add the relationships between issues to GitHub.
+    :Param tigris_issue: Record with the current issue.
+    :Param gh_issue: handle to github issue
+    :Param tigris_to_github: map from tigris issue number to github issue number
+    :Param tigris_id: the number of the current tigris issue
+    :Param gh_id: The number of the github issue
+    '''
+    suffix = get_relationships_text(tigris_issue, gh_issue, tigris_to_github)
     if suffix:
         print("Adding Relationship info for Tigris issue: %d [GH %d]"%(tigris_id, gh_id))
         gh_issue.edit(body=gh_issue.body + suffix)
 
 
-def add_issue_relationships(gh_id, tigris_issue, tigris_id, issue_repo, gh, tigris_to_github):
+def add_issue_relationships(gh_id, tigris_issue, tigris_id, issue_repo, gh, tigris_to_github, issue_states=None):
     """
     :Param gh_id: Integer - The github issue #
-    :Param tigris_issue: The xml Element for the tigris issue
+    :Param tigris_issue: The record for the tigris issue
     :Param tigris_id: The tigris issue id
     :Param issue_repo: Handle to the github repo we're adding issues to
     :Param gh: The Github handle
     :Param tigris_to_github: Dictionary mapping tigris issue # to github issue #
+    :Param issue_states: Optional github_state.IssueStateCache, saves reading the issue
     """
     print("Checking issue relationships for:%d [Github issue:%d]"%(tigris_id, gh_id))
 
-    gh_issue = issue_repo.get_issue(gh_id)
+    gh_issue = get_existing_issue(issue_repo, gh_id, issue_states)
+    if gh_issue is None:
+        print("GitHub issue %d doesn't exist, skipping its relationships" % gh_id)
+        return
     reset_time = gh.rate_limiting_resettime
     if gh.rate_limiting[0] < 10:
         delay = 10 + (reset_time - time.time())
-        print('Waiting ' + delay + 's for rate limit to reset.')
+        print('Waiting ' + str(delay) + 's for rate limit to reset.')
         time.sleep(delay)
     add_relationships(tigris_issue, gh_issue, tigris_to_github, tigris_id, gh_id)
+    if issue_states is not None:
+        issue_states.remember_issue(gh_issue)
     time.sleep(1)
 
-def import_attachment(tigris_issue, gh_issue, attachment_repo, args):
-    '''PyGithub doesn't support the Contents endpoint of the GitHub REST API
-    https://developer.github.com/v3/repos/contents/.
-    :Param tigris_issue: lxml element with all info from tigris issue
-    :Param gh_issue: 
-    :Param attachment_repo: Github handle to attachment_repo
+def get_sorted_attachments(tigris_issue):
+    '''The attachments of an issue, oldest first.'''
+    return sorted(tigris_issue.get('attachment', []), key=lambda x: x.get('date', ''))
+
+
+def route_attachments(tigris_issue, args, attachment_files):
+    '''Decide how each attachment is copied, by its size. Small ones go
+    through the Contents API as before, large ones are uploaded as release
+    assets, which take the raw file instead of a base64 JSON document and
+    have no size limit worth mentioning. The route is kept in the
+    attachment's record as 'route', for the link in the issue.
+    :Param tigris_issue: record with all info from tigris issue
     :Param args: command line argument values
+    :Param attachment_files: The files from fetch_attachments()
     '''
-    suffix = ''
+    for attachment, fd in zip(get_sorted_attachments(tigris_issue), attachment_files):
+        if fd is None:
+            continue
+        fd.seek(0, os.SEEK_END)
+        attachment['route'] = 'asset' if fd.tell() > args.asset_threshold else 'contents'
 
-    tigris_issue_id = tigris_issue.xpath('issue_id')[0].text
 
-    url_prefix = '/'.join(('https://api.github.com/repos',
-                           args.attachment_repo, 'contents', tigris_issue_id))
-    sorted_attachments = sorted(tigris_issue.xpath(
-        'attachment'), key=lambda x: x.xpath('date')[0].text)
+def get_attachment_routes(tigris_issue):
+    '''The routes set by route_attachments(), by attachid, for the journal.'''
+    return dict((attachment['attachid'], attachment['route'])
+                for attachment in get_sorted_attachments(tigris_issue) if 'route' in attachment)
 
 
+def set_attachment_routes(tigris_issue, routes):
+    '''Set the routes of the attachments recorded by the journal, see get_attachment_routes().'''
+    for attachment in get_sorted_attachments(tigris_issue):
+        if attachment['attachid'] in routes:
+            attachment['route'] = routes[attachment['attachid']]
 
-    for attachment in sorted_attachments:
-        attachid = attachment.xpath('attachid')[0].text
-        filename = attachment.xpath('filename')[0].text
-        who = attachment.xpath('submitting_username')[0].text
+
+def get_asset_name(tigris_issue, attachment):
+    '''Name of the release asset of an attachment. The assets of all issues
+    share one release, so the name has the issue and attachment ids, and
+    only characters GitHub keeps as they are, so the link can be made
+    without asking GitHub.
+    '''
+    filename = re.sub(r'[^A-Za-z0-9._-]', '.', attachment['filename'])
+    return '-'.join((tigris_issue['issue_id'], attachment['attachid'], filename))
+
+
+def get_attachment_url(tigris_issue, attachment, args):
+    '''Link to the copy of an attachment in the attachment repo.'''
+    if attachment.get('route') == 'asset':
+        return '/'.join(('https://github.com', args.attachment_repo, 'releases/download',
+                         args.asset_release, get_asset_name(tigris_issue, attachment)))
+    url_suffix = attachment['attachid'] + '/' + attachment['filename']
+    return '/'.join(('https://github.com',
+                     args.attachment_repo, 'blob/master', tigris_issue['issue_id'], url_suffix))
+
+
+def get_attachment_text(tigris_issue, args):
+    '''Text linking to the copies of the attachments in the attachment repo.
+    :Param tigris_issue: record with all info from tigris issue
+    :Param args: command line argument values
+    '''
+    suffix = ''
+    for attachment in get_sorted_attachments(tigris_issue):
+        filename = attachment['filename']
+        who = attachment.get('submitting_username')
         if not who:
             who = 'An anonymous user'
-        url_suffix = attachid + '/' + filename
-        dest_url = url_prefix + '/' + url_suffix
-        comment_url = '/'.join(('https://github.com',
-                                args.attachment_repo, 'blob/master', tigris_issue_id, url_suffix))
+        comment_url = get_attachment_url(tigris_issue, attachment, args)
         suffix += '\r\n' + who
         suffix += ' attached [' + filename + '](' + comment_url + ')'
-        suffix += ' at ' + attachment.xpath('date')[0].text + '.\r\n'
-        desc = attachment.xpath('desc')[0].text
+        suffix += ' at ' + attachment.get('date', '') + '.\r\n'
+        desc = attachment.get('desc')
         if desc:
             suffix += '>' + desc + '\r\n'
+    return suffix
+
+
+def fetch_attachment(attachment):
+    '''Download an attachment from Tigris into a temporary file.
+    Tigris can be flakey, so retry with a delay if the connection is
+    closed by Tigris.
+    :Param attachment: record of the attachment
+    :Return: The temporary file, the caller closes it, or None if Tigris
+             doesn't have the attachment
+    '''
+    r = http_transport.transport.get(attachment['attachment_iz_url'], stream=True, retries=10)
+    if r.status_code >= 400:
+        # Don't fail the whole issue, it just gets a broken link
+        print("Skipping attachment %s, Tigris answered %d" % (attachment['attachment_iz_url'], r.status_code))
+        r.close()
+        return None
+    fd = tempfile.TemporaryFile()
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        fd.write(chunk)
+    return fd
+
+
+def fetch_attachments(tigris_issue):
+    '''Download all the attachments of an issue, see fetch_attachment().'''
+    attachment_files = []
+    try:
+        for attachment in get_sorted_attachments(tigris_issue):
+            attachment_files.append(fetch_attachment(attachment))
+    except Exception:
+        close_attachments(attachment_files)
+        raise
+    return attachment_files
+
+
+def close_attachments(attachment_files):
+    '''Close the files of fetch_attachments().'''
+    for fd in attachment_files:
+        if fd is not None:
+            fd.close()
+
+
+# Upload URL of the asset release of each attachment repo, see get_asset_upload_url()
+asset_release_cache = {}
+asset_release_lock = threading.Lock()
+
+
+def get_asset_upload_url(args):
+    '''Return the upload URL of the release holding the large attachments,
+    creating the release the first time.
+    :Param args: command line argument values
+    '''
+    key = (args.attachment_repo, args.asset_release)
+    with asset_release_lock:
+        if key not in asset_release_cache:
+            releases_url = '/'.join((args.api_url.rstrip('/') + '/repos', args.attachment_repo, 'releases'))
+            auth = (args.username, args.password)
+            r = http_transport.transport.get(releases_url + '/tags/' + args.asset_release, auth=auth)
+            if r.status_code == 404:
+                payload = {
+                    "tag_name": args.asset_release,
+                    "name": "Tigris issue attachments",
+                    "body": "Attachments of the Tigris issues too large for the repository."
+                }
+                r = http_transport.transport.post(releases_url, auth=auth, data=json.dumps(payload))
+            r.raise_for_status()
+            # Drop the URI template, like {?name,label}
+            asset_release_cache[key] = r.json()['upload_url'].split('{')[0]
+        return asset_release_cache[key]
+
+
+def upload_asset(tigris_issue, attachment, fd, args):
+    '''Upload an attachment to the asset release, streaming the file as
+    the raw request body.
+    :Param tigris_issue: record with all info from tigris issue
+    :Param attachment: record of the attachment
+    :Param fd: The downloaded attachment
+    :Param args: command line argument values
+    '''
+    name = get_asset_name(tigris_issue, attachment)
+    content_type = mimetypes.guess_type(attachment['filename'])[0] or 'application/octet-stream'
+    fd.seek(0)
+    r = http_transport.transport.post(get_asset_upload_url(args), params={'name': name}, data=fd,
+                                      headers={'Content-Type': content_type}, auth=(args.username, args.password))
+    if r.status_code == 422:
+        # Uploaded by an earlier run already, attachments don't change
+        print("Release asset %s exists already" % name)
+        return
+    r.raise_for_status()
+
+
+def copy_attachments(tigris_issue, args, governor=None, attachment_files=None):
+    '''Copy the attachments of an issue from Tigris to the attachment repo,
+    each the way route_attachments() decided, see there.
+    PyGithub doesn't support the Contents endpoint of the GitHub REST API
+    https://developer.github.com/v3/repos/contents/.
+    :Param tigris_issue: record with all info from tigris issue
+    :Param args: command line argument values
+    :Param governor: Optional rate_limit.RateGovernor pacing the uploads
+    :Param attachment_files: Optional files from fetch_attachments(), downloaded ahead
+    '''
+    tigris_issue_id = tigris_issue['issue_id']
+
+    url_prefix = '/'.join((args.api_url.rstrip('/') + '/repos',
+                           args.attachment_repo, 'contents', tigris_issue_id))
+
+    for n, attachment in enumerate(get_sorted_attachments(tigris_issue)):
+        url_suffix = attachment['attachid'] + '/' + attachment['filename']
+        dest_url = url_prefix + '/' + url_suffix
 
         # Copy the attachment to a temporary file, and upload to GitHub.
-        # Tigris can be flakey, so retry with a delay if the connection
-        # closed by Tigris.
-        src_url = attachment.xpath('attachment_iz_url')[0].text
-        num_retries = 0
-        while num_retries < 10:
-            try:
-                r = requests.get(src_url, stream=True)
-                break
-            except Exception as e:
-                print("import_attachment(): Exception-->%s"%e)
-                num_retries += 1
-                time.sleep(5)
-        with tempfile.TemporaryFile() as fd:
-            for chunk in r.iter_content(chunk_size=128):
-                fd.write(chunk)
+        if attachment_files is None:
+            fd = fetch_attachment(attachment)
+        else:
+            fd = attachment_files[n]
+        if fd is None:
+            continue
+        try:
+            if attachment.get('route') == 'asset':
+                if governor is not None:
+                    governor.wait()
+                upload_asset(tigris_issue, attachment, fd, args)
+                continue
             fd.seek(0)
             payload = {
                 "path": url_suffix,
-                "message": "Add issue attachment taken from " + src_url,
+                "message": "Add issue attachment taken from " + attachment['attachment_iz_url'],
                 "content": base64.b64encode(fd.read()).decode('ascii')
             }
-            requests.put(dest_url, auth=(args.username, args.password),
-                         data=json.dumps(payload))
-    if suffix:
-        gh_issue.edit(body=gh_issue.body + suffix)
+        finally:
+            if attachment_files is None:
+                fd.close()
+        if governor is not None:
+            governor.wait()
+        r = http_transport.transport.put(dest_url, auth=(args.username, args.password),
+                                         data=json.dumps(payload))
+        if r.status_code == 422:
+            # Copied by an earlier run already, attachments don't change
+            print("Attachment %s exists already" % url_suffix)
+            continue
+        r.raise_for_status()
 
-def upload_to_github(tigris_issue, repo, mapping, attachment_repo, args):
-    '''Import a single Tigris issue into a GitHub repo.
+def get_existing_issue(repo, issue_id, issue_states=None):
+    '''Return the GitHub issue issue_id, or None if there's no such issue yet.
+    Exits if it's a pull request, which we must never overwrite.
 
-    :param tigris_issue: The source issue
-    :param repo: The destination GitHub repository for issues
-    :param mapping: Mapping from tigris issue id to github id to avoid overwritting existing PRs
-    :param attachment_repo: The destination GitHub repository for attachments
-    :param args: command line argument values
+    :param repo: The GitHub repository for issues
+    :param issue_id: The GitHub issue number
+    :param issue_states: Optional github_state.IssueStateCache. The answer then comes
+                         from its batched lookup, and the issue returned is a lazy
+                         handle that doesn't cost a request of its own.
     '''
+    if issue_states is None:
+        try:
+            gh_issue = repo.get_issue(issue_id)
+        except UnknownObjectException:
+            return None
+        is_pull_request = gh_issue.pull_request is not None
+    else:
+        state = issue_states.get(issue_id)
+        if not state['exists']:
+            return None
+        is_pull_request = state['is_pull_request']
+        if not is_pull_request:
+            gh_issue = issue_states.lazy_issue(repo, issue_id)
+
+    # Verify we're not going to overwrite a pull_request.
+    if is_pull_request:
+        print("Trying to update GitHub issue %d and it's a pull request exiting"%issue_id)
+        sys.exit(-1)
+    return gh_issue
 
-    tigris_issue_id = int(tigris_issue.xpath('issue_id')[0].text)
-    issue_id = mapping[tigris_issue_id]
 
-    title = html.unescape(tigris_issue.xpath('short_desc')[0].text)
+def render_issue(tigris_issue, repo, args, tigris_to_github=None):
+    '''Render the complete content of the GitHub issue for a Tigris issue.
 
-    # Overwrite an existing issue, if present.
-    try:
-        gh_issue = repo.get_issue(issue_id)
-
-        # Verify we're not going to overwrite a pull_request.
-        if gh_issue.pull_request is not None:
-            print("Trying to update GitHub issue %d and it's a pull request exiting"%issue_id)
-            sys.exit(-1)
-
-    except UnknownObjectException:
-        # Sleep here to follow GitHub's guideline to wait a second between requests. See
-        # https://developer.github.com/v3/guides/best-practices-for-integrators/#dealing-with-abuse-rate-limits
-        time.sleep(1)
-        gh_issue = repo.create_issue(title)
+    :param tigris_issue: The source issue
+    :param repo: The destination GitHub repository for issues, for the milestone
+    :param args: command line argument values
+    :param tigris_to_github: Mapping from tigris issue id to github id. If given,
+                             the relationships are rendered too
+    :return: Dictionary of keyword arguments for Issue.edit()
+    '''
+    content = render_issue_text(tigris_issue, args, tigris_to_github)
+    content['milestone'] = get_target_milestone(tigris_issue, repo)
+    return content
 
-    time.sleep(5)
 
-    print('Importing Tigris issue {} as new issue {}: "{}"'.format(tigris_issue_id, issue_id, title))
-    if gh_issue.number != issue_id:
-        print(issue_id, gh_issue.number)
-        # Someone's created an issue whilst we working, overwrite theirs.
-        gh_issue = repo.get_issue(issue_id)
+def render_issue_text(tigris_issue, args, tigris_to_github=None):
+    '''Render the GitHub issue for a Tigris issue without touching GitHub,
+    i.e. everything but the milestone. See render_issue().
+    '''
+    title = html.unescape(tigris_issue.get('short_desc', ''))
 
     state = 'open'
-    if tigris_issue.xpath('issue_status')[0].text in (
+    if tigris_issue.get('issue_status') in (
             'RESOLVED', 'CLOSED', 'VERIFIED'):
         state = 'closed'
     # Create the initial body of the issue.
     body = 'This issue was originally created at: ' + \
-        tigris_issue.xpath('creation_ts')[0].text + '.\r\n'
-    reporter = tigris_issue.xpath('reporter')[0].text
+        tigris_issue.get('creation_ts', '') + '.\r\n'
+    reporter = tigris_issue.get('reporter')
     if reporter:
         body += 'This issue was reported by: `' + reporter + '`.\r\n'
 
-    sorted_long_descs = sorted(tigris_issue.xpath(
-        'long_desc'), key=lambda x: x.xpath('issue_when')[0].text)
+    sorted_long_descs = sorted(tigris_issue.get(
+        'long_desc', []), key=lambda x: x.get('issue_when', ''))
 
     for long_desc in sorted_long_descs:
-        body += long_desc.xpath('who')[0].text
+        body += long_desc.get('who', '')
         body += ' said at '
-        body += long_desc.xpath('issue_when')[0].text
-        long_desc_text = long_desc.xpath('thetext')[0].text
+        body += long_desc.get('issue_when', '')
+        long_desc_text = long_desc.get('thetext')
         if not long_desc_text:
             long_desc_text = 'No text was provided with this entry.'
         unescaped_long_desc_text = html.unescape(long_desc_text)
@@ -306,20 +501,246 @@ def upload_to_github(tigris_issue, repo, mapping, attachment_repo, args):
                 line = ' '
             body += '\r\n>' + line
         body += '\r\n\r\n'
-    gh_issue.edit(
+
+    # Each function maps to a field in the Tigris issue, based on the DTD at
+    # http://scons.tigris.org/issues/issuezilla.dtd
+    body += get_file_loc_text(tigris_issue)
+    body += get_votes_text(tigris_issue)
+    body += get_attachment_text(tigris_issue, args)
+    if tigris_to_github is not None:
+        body += get_relationships_text(tigris_issue, None, tigris_to_github)
+
+    return dict(
         title=title,
         body=body,
         state=state,
-        milestone=get_target_milestone(tigris_issue, gh_issue),
         labels=get_labels(tigris_issue)
     )
 
-    # Each function maps to a field in the Tigris issue, based on the DTD at
-    # http://scons.tigris.org/issues/issuezilla.dtd
-    import_issue_file_loc(tigris_issue, gh_issue)
-    import_votes(tigris_issue, gh_issue)
 
-    import_attachment(tigris_issue, gh_issue, attachment_repo, args)
+def upload_to_github(tigris_issue, repo, mapping, attachment_repo, args, issue_states=None, governor=None,
+                     with_relationships=False, content=None, attachment_files=None):
+    '''Import a single Tigris issue into a GitHub repo.
+
+    :param tigris_issue: The source issue
+    :param repo: The destination GitHub repository for issues
+    :param mapping: Mapping from tigris issue id to github id to avoid overwritting existing PRs
+    :param attachment_repo: The destination GitHub repository for attachments
+    :param args: command line argument values
+    :param issue_states: Optional github_state.IssueStateCache with the state of the issues
+    :param governor: Optional rate_limit.RateGovernor pacing the writes
+    :param with_relationships: Also write the relationships, all issue numbers being reserved
+    :param content: Optional result of render_issue(), rendered ahead
+    :param attachment_files: Optional result of fetch_attachments(), downloaded and
+                             passed to route_attachments() ahead
+    '''
+
+    tigris_issue_id = int(tigris_issue['issue_id'])
+    issue_id = mapping[tigris_issue_id]
+
+    title = html.unescape(tigris_issue.get('short_desc', ''))
+
+    # Overwrite an existing issue, if present.
+    gh_issue = get_existing_issue(repo, issue_id, issue_states)
+    if gh_issue is None:
+        # Sleep here to follow GitHub's guideline to wait a second between requests. See
+        # https://developer.github.com/v3/guides/best-practices-for-integrators/#dealing-with-abuse-rate-limits
+        time.sleep(1)
+        gh_issue = repo.create_issue(title)
+        # Exists now, even if filling it in fails
+        if issue_states is not None:
+            issue_states.remember_issue(gh_issue)
+        time.sleep(5)
+
+    print('Importing Tigris issue {} as new issue {}: "{}"'.format(tigris_issue_id, issue_id, title))
+    if gh_issue.number != issue_id:
+        print(issue_id, gh_issue.number)
+        # Someone's created an issue whilst we working, overwrite theirs.
+        gh_issue = repo.get_issue(issue_id)
+
+    # The links to the attachments depend on their sizes, so they're
+    # downloaded before the issue is rendered.
+    downloaded = attachment_files is None
+    if downloaded:
+        attachment_files = fetch_attachments(tigris_issue)
+        route_attachments(tigris_issue, args, attachment_files)
+    try:
+        if content is None:
+            content = render_issue(tigris_issue, repo, args, mapping if with_relationships else None)
+        copy_attachments(tigris_issue, args, governor, attachment_files)
+    finally:
+        if downloaded:
+            close_attachments(attachment_files)
+    if governor is not None:
+        governor.wait()
+    gh_issue.edit(**content)
+    if issue_states is not None:
+        issue_states.remember_issue(gh_issue)
+
+
+PLACEHOLDER_BODY = 'This issue is being migrated from Tigris, its content follows shortly.'
+
+
+def placeholder_title(tigris_id, short_desc):
+    '''
+    Title of the placeholder reserving the GitHub number of a Tigris issue.
+
+    :param tigris_id: The tigris issue id
+    :param short_desc: Summary of the tigris issue, or None if it doesn't exist
+    '''
+    if short_desc is None:
+        return 'Tigris issue %d does not exist' % tigris_id
+    return html.unescape(short_desc)
+
+
+def reserve_issue_numbers(issue_repo, tigris_issues, github_to_tigris, wanted, issue_states, governor, journal):
+    '''
+    Reservation phase of a two phase migration: create a placeholder for
+    every GitHub issue number up to the highest one wanted that doesn't
+    exist yet, strictly in order, so they get the numbers of the mapping.
+    Numbers of issues that don't exist on Tigris get a placeholder too,
+    otherwise all the numbers after them would shift.
+
+    :param issue_repo: GitHub handle for main repo
+    :param tigris_issues: Dictionary of tigris id to issue record
+    :param github_to_tigris: Mapping from github issue number to tigris id
+    :param wanted: Github issue numbers the run works on
+    :param issue_states: github_state.IssueStateCache with the state of the issues
+    :param governor: rate_limit.RateGovernor pacing the writes
+    :param journal: migration_journal.MigrationJournal recording the reservations
+    :return: Number of placeholders created
+    '''
+    if not wanted:
+        return 0
+    last = max(wanted)
+    numbers = [gh_id for gh_id in sorted(github_to_tigris) if gh_id <= last]
+    issue_states.prefetch(numbers)
+
+    reserved = 0
+    for gh_id in numbers:
+        if issue_states.get(gh_id)['exists']:
+            continue
+        tigris_id = github_to_tigris[gh_id]
+        short_desc = tigris_issues[tigris_id].get('short_desc', '') if tigris_id in tigris_issues else None
+        title = placeholder_title(tigris_id, short_desc)
+        reserve_issue_number(issue_repo, gh_id, tigris_id, title, issue_states, governor, journal)
+        reserved += 1
+        if reserved % 100 == 0:
+            print("Reserved %d GitHub issue numbers, up to %d" % (reserved, gh_id))
+    return reserved
+
+
+def reserve_issue_number(issue_repo, gh_id, tigris_id, title, issue_states, governor, journal):
+    '''
+    Create the placeholder for the next free GitHub issue number, which
+    has to be gh_id. Exits if it isn't, someone else is creating issues.
+    '''
+    governor.wait()
+    gh_issue = issue_repo.create_issue(title, body=PLACEHOLDER_BODY)
+    if gh_issue.number != gh_id:
+        print("Reserving GitHub issue %d for Tigris issue %d got issue %d instead, "
+              "someone else is creating issues. Exiting" % (gh_id, tigris_id, gh_issue.number))
+        sys.exit(-1)
+    issue_states.remember_issue(gh_issue)
+    journal.record(tigris_id, gh_id=gh_id, status='reserved')
+
+
+def fill_issues(gh, issue_repo, attachment_repo, tigris_issues, tigris_to_github, tigris_ids, args,
+                issue_states, governor, journal, dead_letters):
+    '''
+    Fill phase of a two phase migration: with all numbers reserved, render
+    and write the issues with args.workers threads, including their
+    relationships.
+
+    :Param tigris_ids: The tigris ids to fill
+    :Param issue_states: github_state.IssueStateCache with the state of the issues
+    :Param governor: rate_limit.RateGovernor shared by all the workers
+    :Param journal: migration_journal.MigrationJournal recording the filled issues
+    :Param dead_letters: dead_letter.DeadLetterQueue retrying the failed issues in the background
+    The other parameters are as for upload_tigris_issue_to_github().
+    :Return: Number of issues filled, not counting those filled by a retry
+    '''
+    filled = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for tigris_id in tigris_ids:
+            future = pool.submit(upload_tigris_issue_to_github, gh, issue_repo, attachment_repo,
+                                 tigris_issues[tigris_id], tigris_to_github, args, issue_states, governor,
+                                 journal=journal, dead_letters=dead_letters, with_relationships=True)
+            futures[future] = tigris_id
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                filled += 1
+    return filled
+
+def run_shard_worker(gh, issue_repo, attachment_repo, tigris_issues, tigris_to_github, wanted, args, governor,
+                     journal, dead_letters):
+    """
+    Two phase migration shared by several worker processes, on one host or
+    more, coordinated by leases in the SQLite file args.lease_db, see
+    lease_store.py. One worker reserves all the numbers, the others wait
+    for it. Then each worker claims ranges of args.shard_size tigris ids
+    and fills in their issues, until no range is left. A worker that
+    crashes loses its range to another one, once the lease expires.
+    All the workers record into the same journal and dead-letter queue.
+
+    :Param wanted: Mapping from github issue number to tigris id of the issues to migrate
+    :Param journal: migration_journal.MigrationJournal shared by all the workers
+    :Param dead_letters: dead_letter.DeadLetterQueue shared by all the workers
+    The other parameters are as for fill_issues().
+    :Return: Number of issues filled by this worker
+    """
+    github_to_tigris = {v: k for k, v in tigris_to_github.items()}
+    leases = lease_store.LeaseStore(args.lease_db, args.worker_id, args.lease_seconds)
+    scope = args.repo
+    leases.add(scope, 'reserve')
+    starts = set((tigris_id - 1) // args.shard_size * args.shard_size + 1 for tigris_id in wanted.values())
+    leases.add_many(scope, 'fill', ((first, first + args.shard_size - 1) for first in sorted(starts)))
+
+    leases.start_heartbeat()
+    try:
+        # Numbers have to be created strictly in order, by one worker
+        while leases.pending(scope, 'reserve'):
+            if leases.claim(scope, 'reserve') is None:
+                time.sleep(min(leases.lease_seconds / 4.0, 10))
+                continue
+            # Another worker may have reserved some before its lease expired
+            issue_states = github_state.IssueStateCache(args.repo, args.password, args.api_url, args.lookup_batch)
+            reserved = reserve_issue_numbers(issue_repo, tigris_issues, github_to_tigris, wanted, issue_states,
+                                             governor, journal)
+            if not leases.finish(scope, 'reserve', 0):
+                # Another worker took over, and checks the numbers again
+                continue
+            print("Reserved %d GitHub issue numbers" % reserved)
+
+        issue_states = github_state.IssueStateCache(args.repo, args.password, args.api_url, args.lookup_batch)
+        filled = 0
+        while True:
+            claimed = leases.claim(scope, 'fill')
+            if claimed is None:
+                if not leases.pending(scope, 'fill'):
+                    break
+                # Wait for the other workers, and take over from any of them
+                # whose lease expires.
+                time.sleep(min(leases.lease_seconds / 4.0, 10))
+                continue
+            first, last = claimed
+            gh_ids = sorted(gh_id for gh_id, tigris_id in wanted.items() if first <= tigris_id <= last)
+            fill_order = [wanted[gh_id] for gh_id in gh_ids]
+            if args.priority:
+                fill_order = issue_index.order_by_priority(tigris_issues, fill_order, args.priority)
+            issue_states.prefetch(gh_ids)
+            print("Worker %s filling in tigris issues %d-%d" % (leases.worker_id, first, last))
+            filled += fill_issues(gh, issue_repo, attachment_repo, tigris_issues, tigris_to_github, fill_order,
+                                  args, issue_states, governor, journal, dead_letters)
+            leases.finish(scope, 'fill', first)
+        # The failed issues are retried in the background meanwhile, wait
+        # for them only once no range is left, instead of holding a lease.
+        filled += dead_letters.drain()
+    finally:
+        leases.stop_heartbeat()
+    return filled
+
 
 def build_tigris_to_github_map(max_tigris_id, issue_repo):
     """
@@ -338,7 +759,7 @@ def build_tigris_to_github_map(max_tigris_id, issue_repo):
     
     # gh_issues = issue_repo.get_issues(state='all', direction='desc')
     # issue_numbers = [i.number for i in gh_issues if not i.pull_request]
-    moved_issue_start_id = max(max(pr_numbers), max_tigris_id)
+    moved_issue_start_id = max(max(pr_numbers, default=0), max_tigris_id)
 
     current_offset = 1
     for tid in range(1, max_tigris_id+1):
@@ -350,28 +771,94 @@ def build_tigris_to_github_map(max_tigris_id, issue_repo):
 
     return (mapping, pr_numbers)
 
-def load_all_tigris_issues():
+def load_tigris_issue_file(issue_group_file):
     """
-    Load all the downloaded tigrix xml files and store in a dictionary
-    keyed by their tigris bug #
+    Parse a single downloaded tigris xml file, plain or compressed. Runs in a worker process,
+    so only plain picklable records are returned.
 
-    :return: Dictionary with key tigris_id and contents is the xml Element
+    :param issue_group_file: Path of the xml file
+    :return: List of (tigris_id, issue record) tuples, in file order
+    """
+    issues = []
+    try:
+        for issue in import_tigris.iter_xml_issues(issue_group_file):
+            if issue.get('status_code') == '404' or not issue.get('issue_id'):
+                # Deleted or never existing issues
+                continue
+            issues.append((int(issue['issue_id']), issue))
+    except lxml.etree.XMLSyntaxError as e:
+        print("Stopped reading %s, it's not valid XML: %s" % (issue_group_file, e))
+    return issues
+
+
+def load_all_tigris_issues(xml_dir='xml', jobs=None):
+    """
+    Load all the downloaded tigrix xml files and store in a dictionary
+    keyed by their tigris bug #. The files are parsed in parallel by
+    jobs processes (default: one per core), and merged in the natural
+    sort order of their names, so an issue found in several files
+    always comes from the last of them.
+
+    :param xml_dir: Directory with the downloaded xml files
+    :param jobs: Number of worker processes, 1 parses in this process
+    :return: Dictionary with key tigris_id and contents is the record
     containing all the issue info
     """
     mapping = {}
-    for issue_group_file in glob.glob('xml/*.xml'):
-        print("Processing: %s"%issue_group_file)
-        with open(issue_group_file, 'rb') as f_in:
-            issues_xml = lxml.etree.XML(f_in.read())
-            
-            issues = issues_xml.xpath('issue')
-            for issue in issues:
-                issue_id = issue.xpath('issue_id')[0].text
-                mapping[int(issue_id)] = issue
+    issue_group_files = import_tigris.chunk_files(xml_dir)
+    jobs = jobs or os.cpu_count() or 1
+    print("Processing %d files with %d job(s)" % (len(issue_group_files), jobs))
+    if jobs > 1 and len(issue_group_files) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(load_tigris_issue_file, issue_group_files)
+            for issues in results:
+                mapping.update(issues)
+    else:
+        for issue_group_file in issue_group_files:
+            mapping.update(load_tigris_issue_file(issue_group_file))
 
     return mapping
 
-def upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issue, mapping, args):
+def iter_chunk_issues(issue_group_file):
+    """
+    Stream the issues of one downloaded tigris xml file, without holding
+    more than one issue.
+
+    :param issue_group_file: Path of the xml file, see import_tigris.chunk_files()
+    :return: Iterator of (tigris_id, issue record) tuples
+    """
+    try:
+        for issue in import_tigris.iter_xml_issues(issue_group_file):
+            if issue.get('status_code') == '404' or not issue.get('issue_id'):
+                # Deleted or never existing issues
+                continue
+            yield int(issue['issue_id']), issue
+    except lxml.etree.XMLSyntaxError as e:
+        print("Stopped reading %s, it's not valid XML: %s" % (issue_group_file, e))
+
+
+def get_max_tigris_id(xml_dir='xml'):
+    """
+    Highest issue id in the downloaded tigris xml files. Taken from the
+    file names where they give the range of ids, only older downloads
+    are read for it.
+
+    :param xml_dir: Directory with the downloaded xml files
+    """
+    max_tigris_id = 0
+    for issue_group_file in import_tigris.chunk_files(xml_dir):
+        id_range = import_tigris.chunk_range(issue_group_file)
+        if id_range:
+            max_tigris_id = max(max_tigris_id, id_range[1])
+        else:
+            for tigris_id, issue in load_tigris_issue_file(issue_group_file):
+                max_tigris_id = max(max_tigris_id, tigris_id)
+    return max_tigris_id
+
+
+def upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issue, mapping, args, issue_states=None,
+                                  governor=None, content=None, attachment_files=None, journal=None,
+                                  dead_letters=None, with_relationships=False):
     """
     Upload a single issue to github.
     NOTE: This will overwrite any existing content in the github issue
@@ -379,16 +866,25 @@ def upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issue,
     :Param gh: Main GitHub connection handle
     :Param issue_repo: GitHub handle for main repo
     :Param attachment_repo: GitHub handle for attachment repo
-    :Param tigris_issue: This is a lxml xml element representing a single issue
+    :Param tigris_issue: This is a record representing a single issue
     :Param mapping: The map of tigris issue number to github issue number
     :Param args: command line argument values
+    :Param issue_states: Optional github_state.IssueStateCache with the state of the issues
+    :Param governor: Optional rate_limit.RateGovernor. If given, it paces the requests instead
+                     of fixed delays
+    :Param content: Optional result of render_issue(), rendered ahead
+    :Param attachment_files: Optional result of fetch_attachments(), downloaded ahead
+    :Param journal: Optional migration_journal.MigrationJournal recording the upload
+    :Param dead_letters: Optional dead_letter.DeadLetterQueue recording a failure
+    :Param with_relationships: Also write the relationships, all issue numbers being reserved
+    :Return: True if the issue was uploaded
     """
 
-    issue_id = int(tigris_issue.xpath('issue_id')[0].text)
+    issue_id = int(tigris_issue['issue_id'])
     print("Uploading issue #%-5d"%issue_id)
 
     reset_time = gh.rate_limiting_resettime
-    if gh.rate_limiting[0] < 10:
+    if governor is None and gh.rate_limiting[0] < 10:
         delay = 10 + (reset_time - time.time())
         print(
             'Waiting ' +
@@ -398,25 +894,419 @@ def upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issue,
 
     # Even though we're respecting the rate limit, and GitHub says at
     # https://developer.github.com/v3/#abuse-rate-limits that this is sufficient,
-    # we still sometimes hit Abuse Rate Limit. If this happens, wait with
+    # we still sometimes hit Abuse Rate Limit. With the numbers reserved, the
+    # issue goes to the dead-letter queue instead of holding up all the
+    # others. Without, the next issue would take its number, so wait with
     # increasing delay and retry.
+    uploaded = False
+    max_retries = 1 if governor is not None else 10
     num_retries = 0
-    while num_retries < 10:
+    while num_retries < max_retries:
         try:
-            upload_to_github(tigris_issue, issue_repo, mapping, attachment_repo, args)
+            upload_to_github(tigris_issue, issue_repo, mapping, attachment_repo, args, issue_states, governor,
+                             with_relationships=with_relationships, content=content,
+                             attachment_files=attachment_files)
+            uploaded = True
             break
         except UnknownObjectException as e:
             print("In upload_tigris_issue_to_github(): Got Exception:%s"%e)
             print("Try another time: Skipping")
+            error = e
             break
 
         except Exception as e:
             print("In upload_tigris_issue_to_github(): Got Exception:%s"%e)
+            error = e
             num_retries += 1
-            time.sleep(60 * num_retries)
+            if num_retries < max_retries:
+                time.sleep(60 * num_retries)
+
+    if not uploaded and dead_letters is not None:
+        dead_letter_issue(gh, issue_repo, attachment_repo, tigris_issue, mapping, args, issue_states, governor,
+                          journal, dead_letters, error, with_relationships)
+
+    if uploaded:
+        if journal is not None:
+            journal.record(issue_id, gh_id=mapping[issue_id], delta_ts=tigris_issue.get('delta_ts', ''),
+                           status='uploaded', attachment_routes=get_attachment_routes(tigris_issue))
+        if dead_letters is not None:
+            dead_letters.resolved(issue_id)
     # Ensure that there's a second delay between successive API
     # calls.
-    time.sleep(5)
+    if governor is None:
+        time.sleep(5)
+    return uploaded
+
+def dead_letter_issue(gh, issue_repo, attachment_repo, tigris_issue, mapping, args, issue_states, governor,
+                      journal, dead_letters, error, with_relationships):
+    """
+    Record a failed issue in the dead-letter queue and, with the numbers
+    reserved, have it retried in the background.
+
+    :Param error: The exception the issue failed with
+    The other parameters are as for upload_tigris_issue_to_github().
+    """
+    issue_id = int(tigris_issue['issue_id'])
+    dead_letters.failed(issue_id, error, gh_id=mapping[issue_id])
+    # UnknownObjectException won't go away by waiting.
+    if governor is not None and not isinstance(error, UnknownObjectException):
+        dead_letters.retry_later(issue_id, lambda: upload_tigris_issue_to_github(
+            gh, issue_repo, attachment_repo, tigris_issue, mapping, args, issue_states, governor,
+            journal=journal, dead_letters=dead_letters, with_relationships=with_relationships))
+
+
+def ordered_stage(func, items, workers, depth):
+    """
+    A pipeline stage: run func over items with a pool of workers threads,
+    and yield the results in the order of items. At most depth items are
+    in flight, so the stage never reads further ahead of its consumer.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = collections.deque()
+        for item in items:
+            in_flight.append(pool.submit(func, item))
+            if len(in_flight) >= depth:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def iter_pipeline_issues(xml_dir, tigris_to_github, args, journal, selected=None, skipped=None):
+    """
+    Load stage of the pipeline: stream the issues the run works on, in the
+    order of their GitHub numbers, in the natural sort order of the xml
+    files. Issues moved past all the others, because a pull request has
+    their number, come at the end: only their ids and files are kept
+    meanwhile, and they're read again from their files, one file at a time.
+    An issue in more than one xml file is streamed once.
+
+    :param xml_dir: Directory with the downloaded xml files
+    :param tigris_to_github: Mapping from tigris issue id to github id
+    :param args: command line argument values
+    :param journal: migration_journal.MigrationJournal, for --sync
+    :param selected: Set of ids to work on, e.g. from --rerun, or None
+    :param skipped: Dictionary filled with the summaries of the issues the
+                    run doesn't work on, for the placeholders of their numbers
+    """
+    # Tigris id to the xml file of each moved issue
+    moved = {}
+    seen = set()
+    for issue_group_file in import_tigris.chunk_files(xml_dir):
+        for tigris_id, tigris_issue in iter_chunk_issues(issue_group_file):
+            if tigris_id in seen:
+                continue
+            seen.add(tigris_id)
+            if (not issue_in_scope(tigris_id, args, selected)
+                    or (args.select and not issue_index.issue_matches(tigris_id, tigris_issue, args.select))
+                    or (args.sync and not journal.is_changed(tigris_id, tigris_issue))):
+                if skipped is not None:
+                    skipped[tigris_id] = tigris_issue.get('short_desc', '')
+                continue
+            if tigris_to_github[tigris_id] != tigris_id:
+                moved[tigris_id] = issue_group_file
+                continue
+            yield tigris_issue
+
+    loaded_file = None
+    loaded = {}
+    for tigris_id in sorted(moved, key=tigris_to_github.get):
+        if moved[tigris_id] != loaded_file:
+            loaded_file = moved[tigris_id]
+            loaded = {}
+            for other_id, tigris_issue in iter_chunk_issues(loaded_file):
+                if moved.get(other_id) == loaded_file and other_id not in loaded:
+                    loaded[other_id] = tigris_issue
+        yield loaded[tigris_id]
+
+
+def run_pipeline(gh, issue_repo, attachment_repo, tigris_to_github, args, issue_states, journal, governor,
+                 dead_letters, xml_dir='xml', selected=None):
+    """
+    Migrate the issues as a streaming pipeline, instead of loading them all
+    first. The stages are
+
+        load      this thread streams the xml files, see iter_pipeline_issues()
+        prefetch  args.prefetch_workers threads download the attachments, and
+                  route them by size, see route_attachments()
+        render    one thread renders the complete issues, relationships and
+                  links to the attachments included
+        upload    this thread creates the issues in order, fills them and
+                  records them in the journal
+
+    with at most args.pipeline_depth issues buffered by each stage, so the
+    memory used doesn't grow with the number of issues. An issue failing in
+    a stage is passed on with its error, and the upload stage puts it in
+    the dead-letter queue instead of stopping the pipeline.
+
+    :Param tigris_to_github: Mapping from tigris issue id to github id
+    :Param issue_states: github_state.IssueStateCache with the state of the issues
+    :Param journal: migration_journal.MigrationJournal recording the uploads
+    :Param governor: rate_limit.RateGovernor pacing the writes
+    :Param dead_letters: dead_letter.DeadLetterQueue retrying the failed issues in the background
+    :Param xml_dir: Directory with the downloaded xml files
+    :Param selected: Set of ids to work on, e.g. from --rerun, or None
+    The other parameters are as for upload_tigris_issue_to_github().
+    :Return: Number of issues uploaded, not counting those uploaded by a retry
+    """
+    github_to_tigris = {v: k for k, v in tigris_to_github.items()}
+    numbers = sorted(github_to_tigris)
+    next_number = 0
+    # Summaries of the issues streamed past, the placeholders of their
+    # numbers get the same titles as with --two_phase.
+    skipped = {}
+
+    def prefetch(tigris_issue):
+        attachment_files = []
+        try:
+            attachment_files = fetch_attachments(tigris_issue)
+            route_attachments(tigris_issue, args, attachment_files)
+        except Exception as e:
+            return tigris_issue, attachment_files, e
+        return tigris_issue, attachment_files, None
+
+    def render(prefetched):
+        tigris_issue, attachment_files, error = prefetched
+        content = None
+        if error is None:
+            try:
+                content = render_issue(tigris_issue, issue_repo, args, tigris_to_github)
+            except Exception as e:
+                error = e
+        return tigris_issue, content, attachment_files, error
+
+    issues = iter_pipeline_issues(xml_dir, tigris_to_github, args, journal, selected, skipped)
+    prefetched = ordered_stage(prefetch, issues, args.prefetch_workers, args.pipeline_depth)
+    rendered = ordered_stage(render, prefetched, 1, args.pipeline_depth)
+
+    uploaded = 0
+    for tigris_issue, content, attachment_files, error in rendered:
+        tigris_id = int(tigris_issue['issue_id'])
+        gh_id = tigris_to_github[tigris_id]
+        try:
+            # GitHub hands out the numbers in order, so every number up to
+            # this issue's has to exist before it can get the right one.
+            while next_number < len(numbers) and numbers[next_number] <= gh_id:
+                number = numbers[next_number]
+                next_number += 1
+                if issue_states.get(number)['exists']:
+                    continue
+                if number == gh_id:
+                    short_desc = tigris_issue.get('short_desc', '')
+                else:
+                    short_desc = skipped.get(github_to_tigris[number])
+                title = placeholder_title(github_to_tigris[number], short_desc)
+                reserve_issue_number(issue_repo, number, github_to_tigris[number], title, issue_states,
+                                     governor, journal)
+
+            if error is not None:
+                # Its number is reserved, so the issues after it go on
+                print("Preparing tigris issue %d failed: %s" % (tigris_id, error))
+                dead_letter_issue(gh, issue_repo, attachment_repo, tigris_issue, tigris_to_github, args,
+                                  issue_states, governor, journal, dead_letters, error, True)
+                continue
+            if upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issue, tigris_to_github, args,
+                                             issue_states, governor, content, attachment_files, journal,
+                                             dead_letters, with_relationships=True):
+                uploaded += 1
+        finally:
+            close_attachments(attachment_files)
+    return uploaded
+
+
+def list_github_issues(issue_repo):
+    """
+    List all the issues and pull requests of a repo, with one request per
+    page of them instead of one per issue.
+
+    :return: Dictionary of github issue number to PyGithub issue
+    """
+    gh_issues = {}
+    for gh_issue in issue_repo.get_issues(state='all', sort='created', direction='asc'):
+        gh_issues[gh_issue.number] = gh_issue
+    return gh_issues
+
+
+def reconcile_issue(tigris_issue, gh_issue, tigris_to_github, args):
+    """
+    Compare a GitHub issue to what the migration would write for its Tigris issue.
+
+    :param tigris_issue: The source issue
+    :param gh_issue: The listed PyGithub issue, or None if there's none
+    :param tigris_to_github: Mapping from tigris issue id to github id
+    :param args: command line argument values
+    :return: Dictionary of field to expected and actual values, empty if
+    the issue is as it should be
+    """
+    if gh_issue is None:
+        return {'missing': {'expected': True, 'actual': False}}
+    # Not gh_issue.pull_request, listed issues lack it and PyGithub would
+    # read the issue to complete it.
+    if '/pull/' in gh_issue.html_url:
+        return {'pull_request': {'expected': False, 'actual': True}}
+
+    expected = render_issue_text(tigris_issue, args, tigris_to_github)
+    tigris_milestone = tigris_issue.get('target_milestone')
+    if not tigris_milestone or tigris_milestone == '-unspecified-':
+        tigris_milestone = None
+    compared = (
+        ('title', expected['title'], gh_issue.title),
+        ('state', expected['state'], gh_issue.state),
+        ('labels', sorted(set(expected['labels'])), sorted(label.name for label in gh_issue.labels)),
+        ('milestone', tigris_milestone, gh_issue.milestone.title if gh_issue.milestone else None),
+        ('body_hash', github_state.body_hash(expected['body']), github_state.body_hash(gh_issue.body)),
+    )
+    return dict((field, {'expected': expected_value, 'actual': actual_value})
+                for field, expected_value, actual_value in compared if expected_value != actual_value)
+
+
+def reconcile_issues(issue_repo, tigris_issues, tigris_to_github, args, selected, report_path, journal):
+    """
+    Check all the migrated issues of a repo against their Tigris issues,
+    and write the drifted ones to a JSON report, which --rerun takes.
+
+    :param issue_repo: GitHub handle for main repo
+    :param tigris_issues: Dictionary of tigris id to issue record
+    :param tigris_to_github: Mapping from tigris issue id to github id
+    :param args: command line argument values
+    :param selected: Set of ids matching --select, or None
+    :param report_path: Path of the report to write
+    :param journal: migration_journal.MigrationJournal, with the routes of the attachments
+    :return: Number of drifted issues
+    """
+    gh_issues = list_github_issues(issue_repo)
+    print("Listed %d GitHub issues and pull requests" % len(gh_issues))
+
+    drifted = []
+    counts = {}
+    checked = 0
+    for tigris_id in sorted(tigris_issues):
+        if not issue_in_scope(tigris_id, args, selected):
+            continue
+        checked += 1
+        gh_id = tigris_to_github[tigris_id]
+        # Link the attachments where the upload put them
+        set_attachment_routes(tigris_issues[tigris_id], journal.get(tigris_id).get('attachment_routes', {}))
+        differences = reconcile_issue(tigris_issues[tigris_id], gh_issues.get(gh_id), tigris_to_github, args)
+        if differences:
+            drifted.append({'tigris_id': tigris_id, 'gh_id': gh_id, 'differences': differences})
+            for field in differences:
+                counts[field] = counts.get(field, 0) + 1
+
+    report = {
+        'repo': args.repo,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'checked': checked,
+        'drifted': drifted,
+    }
+    with open(report_path, 'w') as f_out:
+        json.dump(report, f_out, indent=1, sort_keys=True)
+    print("Checked %d issues, %d drifted%s, see %s" %
+          (checked, len(drifted),
+           ''.join(', %d %s' % (counts[field], field) for field in sorted(counts)), report_path))
+    return len(drifted)
+
+
+def plan_migration(issue_repo, tigris_issues, tigris_to_github, pr_numbers, args, selected, issue_states):
+    """
+    Count what uploading the issues in scope would do in the upload mode
+    chosen, without changing anything, and print the plan and estimated
+    time. Only reads the state of the issues, milestones and labels.
+
+    :param issue_repo: GitHub handle for main repo
+    :param tigris_issues: Dictionary of tigris id to issue record
+    :param tigris_to_github: Mapping from tigris issue id to github id
+    :param pr_numbers: Numbers of the pull requests of the repo
+    :param args: command line argument values
+    :param selected: Set of ids matching --select, or None
+    :param issue_states: github_state.IssueStateCache
+    :return: The planner.MigrationPlan
+    """
+    if args.pipeline:
+        mode = 'pipeline'
+    elif args.two_phase:
+        mode = 'two_phase'
+    else:
+        mode = 'default'
+    plan = planner.MigrationPlan(mode)
+
+    github_to_tigris = {v: k for k, v in tigris_to_github.items()}
+    wanted = wanted_issues(github_to_tigris, tigris_issues, args, selected)
+    if mode == 'default':
+        numbers = sorted(wanted)
+    else:
+        # Every missing number up to the last one wanted gets a placeholder
+        last = max(wanted) if wanted else 0
+        numbers = [gh_id for gh_id in sorted(github_to_tigris) if gh_id <= last]
+
+    plan.add_call('GET repo', 2)
+    plan.add_call('GET pulls', max(1, -(-len(pr_numbers) // 100)))
+    plan.add_call('POST graphql', -(-len(numbers) // args.lookup_batch))
+    issue_states.prefetch(numbers)
+    for gh_id in numbers:
+        exists = issue_states.get(gh_id)['exists']
+        if gh_id in wanted:
+            plan.issues += 1
+            if exists:
+                plan.updates += 1
+            else:
+                plan.creates += 1
+                plan.add_call('POST issues')
+        elif not exists:
+            plan.placeholders += 1
+            plan.add_call('POST issues')
+
+    existing_milestones = set(m.title for m in issue_repo.get_milestones())
+    existing_labels = set(label.name for label in issue_repo.get_labels())
+    milestones = set()
+    attachment_urls = []
+    for gh_id in sorted(wanted):
+        tigris_issue = tigris_issues[wanted[gh_id]]
+        plan.add_call('PATCH issue')
+        tigris_milestone = tigris_issue.get('target_milestone')
+        if tigris_milestone and tigris_milestone != '-unspecified-':
+            milestones.add(tigris_milestone)
+        plan.new_labels.update(label for label in get_labels(tigris_issue) if label not in existing_labels)
+        attachment_urls.extend(attachment['attachment_iz_url'] for attachment in get_sorted_attachments(tigris_issue))
+        edges = sum(1 for field_name in ('dependson', 'blocks', 'is_duplicate', 'has_duplicates')
+                    for field in tigris_issue.get(field_name, []) if field.get('issue_id'))
+        if edges:
+            plan.relationship_edges += edges
+            plan.relationship_issues += 1
+            if mode == 'default':
+                # Written by a pass of its own
+                plan.add_call('PATCH issue')
+    plan.new_milestones = milestones - existing_milestones
+    # Each milestone is looked up once, then cached
+    plan.add_call('GET milestones', len(milestones))
+    plan.add_call('POST milestones', len(plan.new_milestones))
+
+    plan.attachments = len(attachment_urls)
+    plan.add_call('Tigris attachment', plan.attachments)
+    if args.plan_sizes:
+        sizes = planner.attachment_sizes(attachment_urls, args.workers)
+        plan.attachment_bytes = sum(size for size in sizes if size is not None)
+        plan.unknown_sizes = sum(1 for size in sizes if size is None)
+        # See route_attachments()
+        assets = sum(1 for size in sizes if size is not None and size > args.asset_threshold)
+        if assets:
+            plan.add_call('GET release')
+            plan.add_call('POST asset', assets)
+        plan.add_call('PUT contents', plan.attachments - assets)
+    else:
+        plan.unknown_sizes = plan.attachments
+        plan.add_call('PUT contents', plan.attachments)
+
+    print("Plan for %s, %s upload:" % (args.repo, mode))
+    print('\n'.join(plan.report(args.rate_budget, args.write_interval, args.workers, args.latency)))
+    return plan
+
+
+def read_rerun_report(report_path):
+    """Return the set of tigris ids of the drifted issues of a reconcile report."""
+    with open(report_path, 'r') as f_in:
+        report = json.load(f_in)
+    return set(entry['tigris_id'] for entry in report['drifted'])
+
 
 def sanity_check_mapping(mapping, max_tigris_id, pr_numbers):
     """
@@ -437,9 +1327,17 @@ def sanity_check_mapping(mapping, max_tigris_id, pr_numbers):
 def process_command_line():
     parser = argparse.ArgumentParser(description="Migrate bugs from tigris bug tracke to Github issues")
     parser.add_argument('--username', required=True, help="GitHub username")
-    parser.add_argument('--password', required=True, help="GitHub password or Personal access token if 2FA is enabled")
-    parser.add_argument('--repo', required=True, help='Target GitHub Repo for issues form is SCons/SCons (not https...)')
-    parser.add_argument('--attachment_repo', required=True, help='GitHub Repo to copy tigris bug attachements to')
+    parser.add_argument('--password', required=True, help="GitHub personal access token. GitHub no longer takes account passwords for its API, "
+                             "and the issue lookups use GraphQL, which never did")
+    parser.add_argument('--repo', help='Target GitHub Repo for issues form is SCons/SCons (not https...)')
+    parser.add_argument('--attachment_repo', help='GitHub Repo to copy tigris bug attachements to')
+    parser.add_argument('--project', default='scons', help='Tigris project to migrate')
+    parser.add_argument('--xml_dir', default='xml', help='Directory for the xml files downloaded from Tigris')
+    parser.add_argument('--manifest',
+                        help='JSON file listing several projects to migrate concurrently, instead of --project, '
+                             '--repo and --attachment_repo')
+    parser.add_argument('--parallel_projects', type=int, default=2,
+                        help='Number of projects of --manifest migrated at the same time')
     parser.add_argument('--skip_import', action='store_true', default=False, help="Skip importing from tigris, use existing local cache")
     parser.add_argument('--skip_upload_to_github', action='store_false', dest='upload_to_github', 
                         default=True, help="Upload the tigris bugs to github")
@@ -447,26 +1345,192 @@ def process_command_line():
     parser.add_argument('--start_issue', type=int, help="Start at this tigris issue")
     parser.add_argument('--end_issue', type=int, help='End at his tigris issue')
     parser.add_argument('--relationship_only', default=False, action='store_true', help='Only update the relationships')
+    parser.add_argument('--jobs', type=int, help='Number of processes parsing the xml files (default: one per core)')
+    parser.add_argument('--api_url', default=github_state.DEFAULT_API_URL,
+                        help='Base URL of the GitHub API, e.g. of a local stand-in for testing')
+    parser.add_argument('--lookup_batch', type=int, default=100,
+                        help='Number of GitHub issues looked up per GraphQL request')
+    parser.add_argument('--two_phase', action='store_true', default=False,
+                        help='First reserve all GitHub issue numbers in order, then fill in the issues in parallel')
+    parser.add_argument('--workers', type=int, default=4, help='Number of threads filling in issues with --two_phase')
+    parser.add_argument('--priority', action='append', default=[], type=issue_index.parse_priority,
+                        metavar='PRIORITY',
+                        help="Order in which --two_phase fills in the issues: 'open' issues first, 'recent'ly changed "
+                             "ones first, or those matching a filter like 'milestone=2.0' first. Can be repeated, "
+                             "the first one weighs most")
+    parser.add_argument('--lease_db',
+                        help='SQLite file through which several --two_phase workers, on one host or more, '
+                             'share the migration, each claiming ranges of issues to fill in')
+    parser.add_argument('--worker_id', help='Name of this worker for --lease_db (default: host name and process id)')
+    parser.add_argument('--shard_size', type=int, default=100,
+                        help='Number of tigris ids in a range claimed by a --lease_db worker')
+    parser.add_argument('--lease_seconds', type=float, default=120,
+                        help='Seconds after which a range of a --lease_db worker that stopped '
+                             'sending heartbeats is taken over')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help="Stream the issues through load, render, attachment download and upload stages, "
+                             "instead of loading them all first")
+    parser.add_argument('--prefetch_workers', type=int, default=4,
+                        help='Number of threads downloading attachments ahead with --pipeline')
+    parser.add_argument('--pipeline_depth', type=int, default=20,
+                        help='Number of issues buffered by each stage of --pipeline')
+    parser.add_argument('--write_interval', type=float, default=1.0,
+                        help='Seconds between write requests to GitHub with --two_phase or --pipeline')
+    parser.add_argument('--asset_threshold', type=int, default=1024 * 1024, metavar='BYTES',
+                        help='Upload attachments larger than this as release assets of the attachment repo, '
+                             'instead of through the Contents API')
+    parser.add_argument('--asset_release', default='tigris-attachments',
+                        help='Tag of the release of the attachment repo holding the large attachments')
+    parser.add_argument('--reconcile', metavar='REPORT',
+                        help='Instead of uploading, compare the GitHub issues to the Tigris ones and write the '
+                             'drifted issues to the JSON file REPORT')
+    parser.add_argument('--plan', action='store_true', default=False,
+                        help='Instead of uploading, report what the upload would do and estimate how long it takes')
+    parser.add_argument('--plan_sizes', action='store_true', default=False,
+                        help='Get the sizes of the attachments for --plan, with a HEAD request each')
+    parser.add_argument('--rate_budget', type=int, default=5000,
+                        help='GitHub requests per hour the token may make, for --plan')
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='Seconds a request takes on average, for --plan')
+    parser.add_argument('--rerun', metavar='REPORT', help='Only work on the drifted issues of a --reconcile report')
+    parser.add_argument('--journal', default='migration_journal.jsonl',
+                        help='File recording the issues uploaded to GitHub, and the Tigris delta_ts they had')
+    parser.add_argument('--dead_letters', default='dead_letters.jsonl',
+                        help='File recording the issues that failed to upload, with the error and number of attempts')
+    parser.add_argument('--max_attempts', type=int, default=5,
+                        help='Number of attempts at uploading an issue before leaving it in --dead_letters')
+    parser.add_argument('--retry_delay', type=float, default=60,
+                        help='Seconds before retrying a failed issue in the background, doubling with each retry')
+    parser.add_argument('--retry_failed', action='store_true', default=False,
+                        help='Only upload the issues that failed before, as recorded in --dead_letters')
+    parser.add_argument('--sync', action='store_true', default=False,
+                        help='Only upload issues that are new, or changed on Tigris since the journal recorded them')
+    parser.add_argument('--select', action='append', default=[], type=issue_index.parse_filter, metavar='FILTER',
+                        help="Only work on issues matching FILTER, e.g. 'status=NEW,STARTED', 'milestone!=-unspecified-', "
+                             "'attachments=yes', 'reporter=someone', 'changed>=2005-01-01'. Can be repeated, "
+                             "issues have to match all filters")
     args = parser.parse_args()
+    if args.pipeline and (args.two_phase or args.relationship_only):
+        parser.error('--pipeline writes the relationships along with the issues, '
+                     "it can't be used with --two_phase or --relationship_only")
+    if args.reconcile and args.pipeline:
+        parser.error("--reconcile compares all issues at once, it can't be used with --pipeline")
+    if args.retry_failed and not (args.two_phase or args.pipeline):
+        parser.error('--retry_failed needs --two_phase or --pipeline, which reserve the numbers of the '
+                     'failed issues first')
+    if args.lease_db and not args.two_phase:
+        parser.error('--lease_db shares the fill phase of --two_phase between workers')
+    if args.lease_db and args.relationship_only:
+        parser.error("--lease_db workers write the relationships along with the issues, "
+                     "it can't be used with --relationship_only")
+    if args.priority and not args.two_phase:
+        parser.error('--priority orders the fill phase of --two_phase')
+    if args.manifest:
+        if not (args.two_phase or args.pipeline):
+            parser.error('--manifest needs --two_phase or --pipeline, so all projects share one rate governor')
+    elif not (args.repo and args.attachment_repo):
+        parser.error('--repo and --attachment_repo are required')
 
 
     return args
 
 
-def main():
+def issue_in_scope(tigris_id, args, selected):
+    """
+    Whether a run works on an issue
+    :param tigris_id: The tigris issue id
+    :param args: command line argument values
+    :param selected: Set of ids matching --select, or None
+    """
+    if args.start_issue and tigris_id < args.start_issue:
+        return False
+    elif args.end_issue and tigris_id > args.end_issue:
+        return False
+    return selected is None or tigris_id in selected
 
+
+def wanted_issues(github_to_tigris, tigris_issues, args, selected):
+    """
+    The issues a run uploads. The mapping covers every id up to the
+    highest one, but deleted Tigris issues aren't loaded, so they're left
+    out here, instead of every caller having to look out for them.
+
+    :param github_to_tigris: Mapping from github issue number to tigris id
+    :param tigris_issues: Dictionary of tigris id to issue record
+    :param args: command line argument values
+    :param selected: Set of ids matching --select, or None
+    :return: Mapping from github issue number to tigris id
+    """
+    return {gh_id: tigris_id for gh_id, tigris_id in github_to_tigris.items()
+            if tigris_id in tigris_issues and issue_in_scope(tigris_id, args, selected)}
+
+
+# Settings a project of a --manifest may have, besides the command line ones
+MANIFEST_KEYS = ('project', 'repo', 'attachment_repo', 'xml_dir', 'journal', 'dead_letters', 'start_issue',
+                 'end_issue')
+
+
+def load_manifest(path, args):
+    """
+    Read the projects of a batch migration. The manifest is a JSON list of
+    objects like
+
+        {"project": "scons", "repo": "SCons/scons",
+         "attachment_repo": "SCons/scons-attachments"}
+
+    which may also set xml_dir (default: xml/<project>), journal (default:
+    migration_journal-<project>.jsonl), dead_letters (default:
+    dead_letters-<project>.jsonl), start_issue and end_issue.
+
+    :param path: Path of the manifest
+    :param args: command line argument values, the defaults of all projects
+    :return: List of argument values, one per project
+    """
+    with open(path, 'r') as f_in:
+        entries = json.load(f_in)
+    projects = []
+    for entry in entries:
+        unknown = set(entry) - set(MANIFEST_KEYS)
+        missing = set(('project', 'repo', 'attachment_repo')) - set(entry)
+        if unknown or missing:
+            print("Bad project %s in %s, unknown: %s, missing: %s" %
+                  (entry, path, ', '.join(sorted(unknown)) or '-', ', '.join(sorted(missing)) or '-'))
+            sys.exit(-1)
+        project_args = argparse.Namespace(**vars(args))
+        project_args.xml_dir = os.path.join('xml', entry['project'])
+        project_args.journal = 'migration_journal-%s.jsonl' % entry['project']
+        project_args.dead_letters = 'dead_letters-%s.jsonl' % entry['project']
+        for key, value in entry.items():
+            setattr(project_args, key, value)
+        projects.append(project_args)
+    return projects
+
+
+def migrate_project(args, gh, governor=None):
+    """
+    Migrate one Tigris project to its GitHub repo.
+
+    :param args: command line argument values, or those of a project of the manifest
+    :param gh: Main GitHub connection handle
+    :param governor: rate_limit.RateGovernor pacing the writes for --two_phase and
+                     --pipeline, shared by all projects migrated at the same time
+    """
     max_tigris_id =0
-    args = process_command_line()
 
     if not args.skip_import:
         # Export the issues from Tigris as XML into a directory.
-        max_tigris_id = import_tigris.fetch_files('scons', 'xml')
-
-    tigris_issues = load_all_tigris_issues()
-    max_issue_from_files = max(tigris_issues.keys())
-    max_tigris_id = max(max_tigris_id, max_issue_from_files)
-
-    gh = Github(args.username, args.password)
+        max_tigris_id = import_tigris.fetch_files(args.project, args.xml_dir)
+
+    # A plan needs all the issues, even for --pipeline
+    streaming = args.pipeline and not args.plan
+    if streaming:
+        # The issues are streamed later, only the highest id is needed now
+        tigris_issues = None
+        max_tigris_id = max(max_tigris_id, get_max_tigris_id(args.xml_dir))
+    else:
+        tigris_issues = load_all_tigris_issues(args.xml_dir, jobs=args.jobs)
+        max_issue_from_files = max(tigris_issues.keys())
+        max_tigris_id = max(max_tigris_id, max_issue_from_files)
 
     attachment_repo = gh.get_repo(args.attachment_repo)
     issue_repo = gh.get_repo(args.repo)
@@ -479,32 +1543,96 @@ def main():
     if args.sanity_check:
         sanity_check_mapping(tigris_to_github, max_tigris_id, pr_numbers)
 
+    journal = migration_journal.MigrationJournal(args.journal)
+    dead_letters = dead_letter.DeadLetterQueue(args.dead_letters, args.max_attempts, args.retry_delay,
+                                               reset_attempts=args.retry_failed)
+
+    selected = None
+    if args.rerun:
+        selected = read_rerun_report(args.rerun)
+        print("Re-running %d drifted issues of %s" % (len(selected), args.rerun))
+    if args.retry_failed:
+        failed = dead_letters.pending()
+        print("Retrying %d failed issues of %s" % (len(failed), args.dead_letters))
+        selected = failed if selected is None else selected & failed
+    # With --pipeline, the issues are selected while streaming them instead,
+    # see iter_pipeline_issues()
+    if args.select and not streaming:
+        index = issue_index.build_issue_index(tigris_issues)
+        matching = issue_index.select_issues(index, args.select)
+        selected = matching if selected is None else selected & matching
+        print("Selected %d of %d issues" % (len(selected), len(tigris_issues)))
+    if args.sync and not streaming:
+        changed = journal.changed_issues(tigris_issues)
+        print("%d of %d issues are new or changed since the last sync" % (len(changed), len(tigris_issues)))
+        selected = changed if selected is None else selected & changed
+
+    if args.reconcile:
+        reconcile_issues(issue_repo, tigris_issues, tigris_to_github, args, selected, args.reconcile, journal)
+        return
+
+    if args.plan:
+        issue_states = github_state.IssueStateCache(args.repo, args.password, args.api_url, args.lookup_batch)
+        plan_migration(issue_repo, tigris_issues, tigris_to_github, pr_numbers, args, selected, issue_states)
+        return
+
     if args.upload_to_github:
         github_to_tigris = {v: k for k, v in tigris_to_github.items()}
 
+        # Look up the current state of all the issues we're going to touch
+        # in batches, instead of reading them one by one.
+        issue_states = github_state.IssueStateCache(args.repo, args.password, args.api_url, args.lookup_batch)
+        if args.pipeline:
+            uploaded = run_pipeline(gh, issue_repo, attachment_repo, tigris_to_github, args, issue_states, journal,
+                                    governor, dead_letters, args.xml_dir, selected)
+            uploaded += dead_letters.drain()
+            print("Uploaded %d issues, %d failed, see %s" % (uploaded, len(dead_letters.pending()), args.dead_letters))
+            return
+        wanted = wanted_issues(github_to_tigris, tigris_issues, args, selected)
+        if args.lease_db:
+            filled = run_shard_worker(gh, issue_repo, attachment_repo, tigris_issues, tigris_to_github, wanted, args,
+                                      governor, journal, dead_letters)
+            print("Filled in %d of %d issues in this worker, %d failed, see %s" %
+                  (filled, len(wanted), len(dead_letters.pending()), args.dead_letters))
+            return
+        issue_states.prefetch(sorted(wanted))
+
+        if args.two_phase and not args.relationship_only:
+            reserved = reserve_issue_numbers(issue_repo, tigris_issues, github_to_tigris, wanted, issue_states,
+                                             governor, journal)
+            print("Reserved %d GitHub issue numbers" % reserved)
+            # With all the numbers reserved, the issues can be filled in any
+            # order, so the most useful ones go live first.
+            fill_order = [wanted[gh_id] for gh_id in sorted(wanted)]
+            if args.priority:
+                fill_order = issue_index.order_by_priority(tigris_issues, fill_order, args.priority)
+            filled = fill_issues(gh, issue_repo, attachment_repo, tigris_issues, tigris_to_github,
+                                 fill_order, args, issue_states, governor, journal, dead_letters)
+            filled += dead_letters.drain()
+            print("Filled in %d of %d issues, %d failed, see %s" %
+                  (filled, len(wanted), len(dead_letters.pending()), args.dead_letters))
+            # The fill phase wrote the relationships already
+            return
+
         if not args.relationship_only:
             processed = 1
-            for gh_index in sorted(github_to_tigris):
-                tigris_index = github_to_tigris[gh_index]
-                if args.start_issue and tigris_index < args.start_issue:
-                    continue
-                elif args.end_issue and tigris_index > args.end_issue:
-                    continue
+            for gh_index in sorted(wanted):
+                tigris_index = wanted[gh_index]
 
                 if processed % 100 == 0:
                     print("upload_tigris_issue_to_github()->Sleeping every 100 for 1 minute")
                     time.sleep(60)
 
-                upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issues[tigris_index], tigris_to_github, args)
+                tigris_issue = tigris_issues[tigris_index]
+                upload_tigris_issue_to_github(gh, issue_repo, attachment_repo, tigris_issue, tigris_to_github, args,
+                                              issue_states, journal=journal, dead_letters=dead_letters)
                 processed += 1
 
 
         # Now all the issues are in imported add the relationships between them.
         for tigris_id in tigris_issues:
 
-            if args.start_issue and tigris_id < args.start_issue:
-                continue
-            elif args.end_issue and tigris_id > args.end_issue:
+            if not issue_in_scope(tigris_id, args, selected):
                 continue
 
             if tigris_id % 100 == 0:
@@ -513,9 +1641,41 @@ def main():
 
 
             gh_id=tigris_to_github[tigris_id]
-            add_issue_relationships(gh_id, tigris_issues[tigris_id], tigris_id, issue_repo, gh, tigris_to_github)
+            add_issue_relationships(gh_id, tigris_issues[tigris_id], tigris_id, issue_repo, gh, tigris_to_github,
+                                    issue_states)
+
+
+def main():
+    args = process_command_line()
+
+    governor = None
+    if args.two_phase or args.pipeline:
+        # The rate governor paces the writes of all workers together, so
+        # PyGithub mustn't pace them on its own as well.
+        pool_size = args.workers * (args.parallel_projects if args.manifest else 1)
+        gh = Github(args.username, args.password, base_url=args.api_url, per_page=100,
+                    seconds_between_writes=None, pool_size=pool_size)
+        http_transport.transport.set_pool_size(args.api_url, pool_size)
+        governor = rate_limit.RateGovernor(args.write_interval, gh)
+    else:
+        gh = Github(args.username, args.password, base_url=args.api_url, per_page=100)
+
+    if not args.manifest:
+        migrate_project(args, gh, governor)
+        return
+
+    # All projects upload with the same token, so they share its rate
+    # limit through the one governor.
+    projects = load_manifest(args.manifest, args)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.parallel_projects) as pool:
+        futures = {pool.submit(migrate_project, project_args, gh, governor): project_args.project
+                   for project_args in projects}
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            print("Migrated project %s" % futures[future])
 
 
 
 if __name__ == '__main__':
     main()
+    print('\n'.join(http_transport.transport.report()))